@@ -1,15 +1,13 @@
+# Importing this package should stay cheap: heavy libraries are imported, and
+# connections made, on first use or at application startup.
+import asyncio
 import configparser
 import os
+from functools import cache
+from threading import Lock
+from typing import Any, Callable
 
-import dspy
 import numpy as np
-from lightrag import LightRAG, QueryParam
-from lightrag.kg.shared_storage import initialize_pipeline_status
-from lightrag.llm.openai import openai_complete_if_cache, openai_embed
-from lightrag.utils import EmbeddingFunc
-from linkml_store import Client as LinkMlClient
-from neo4j import GraphDatabase
-from openai import OpenAI
 
 config = configparser.ConfigParser()
 
@@ -19,15 +17,50 @@ cohere_config = config["cohere"]
 # Maybe move to config?
 chat_model = cohere_config.get("chat_model", "command-a-03-2025")
 embed_model = cohere_config.get("embed_model", "embed-english-v3.0")
+# Texts per embedding request, the Cohere embed endpoint takes at most 96
+EMBEDDING_BATCH_SIZE = cohere_config.getint("embedding_batch_size", 96)
 cohere_key = cohere_config.get("apikey")
 cohere_url = "https://api.cohere.ai/compatibility/v1"
 CHUNK_TOKEN_SIZE = 1024
 MAX_TOKENS = 4000
+# Tokens a case description may use in sieve prompts before it gets summarized
+PROMPT_TOKEN_BUDGET = config.getint("sieve", "prompt_tokens", fallback=MAX_TOKENS // 2)
+# How many templates are scored against the LLM at the same time
+SIEVE_CONCURRENCY = config.getint("sieve", "concurrency", fallback=8)
+# Seconds before giving up on a single template evaluation
+SIEVE_TIMEOUT = config.getfloat("sieve", "timeout", fallback=60.0)
+# How many templates the embedding prefilter lets through to the LLM (0 to score all)
+SIEVE_SHORTLIST = config.getint("sieve", "shortlist", fallback=0)
+# How many cases a batch evaluation job works on at the same time
+JOB_WORKERS = config.getint("jobs", "workers", fallback=4)
+# How many objects are written per transaction by bulk imports
+INGEST_BATCH_SIZE = config.getint("ingest", "batch_size", fallback=1000)
+# How many compiled templates each worker keeps in memory
+TEMPLATE_CACHE_SIZE = config.getint("sieve", "template_cache_size", fallback=1000)
+# How many generated schema classes, templates and their shared parts, are kept
+SCHEMA_REGISTRY_SIZE = config.getint(
+    "sieve", "schema_registry_size", fallback=10 * TEMPLATE_CACHE_SIZE
+)
+# Seconds between checks for templates edited by other workers
+VERSION_CHECK_INTERVAL = config.getfloat(
+    "sieve", "version_check_interval", fallback=5.0
+)
+# How many templates evaluate_case scores per wave before it stops, if one reached
+# confidence_threshold (0 to score all of them at once)
+SIEVE_WAVE_SIZE = config.getint("sieve", "wave_size", fallback=0)
+# Confidence from which a template is a good enough match to stop looking further
+SIEVE_THRESHOLD = config.getfloat("sieve", "confidence_threshold", fallback=0.8)
+# Whether the sieve scores several templates per LLM call, instead of one
+SIEVE_PACKED = config.getboolean("sieve", "packed", fallback=False)
+# Whether to compile all current templates at startup
+SIEVE_WARM_UP = config.getboolean("sieve", "warm_up", fallback=True)
 
 
 async def llm_model_func(
     prompt, system_prompt=None, history_messages=[], keyword_extraction=False, **kwargs
 ) -> str:
+    from lightrag.llm.openai import openai_complete_if_cache
+
     return await openai_complete_if_cache(
         chat_model,
         prompt,
@@ -40,6 +73,8 @@ async def llm_model_func(
 
 
 async def embedding_func(texts: list[str]) -> np.ndarray:
+    from lightrag.llm.openai import openai_embed
+
     return await openai_embed(
         texts,
         model=embed_model,
@@ -48,28 +83,89 @@ async def embedding_func(texts: list[str]) -> np.ndarray:
     )
 
 
-cohere_client = OpenAI(
-    base_url=cohere_url,
-    api_key=cohere_key,
-)
+class Lazy:
+    """Proxy to an object built by `factory` the first time one of its attributes is used."""
+
+    def __init__(self, factory: Callable[[], Any]):
+        self._factory = factory
+        self._target = None
+        self._lock = Lock()
+
+    def _get(self) -> Any:
+        if self._target is None:
+            with self._lock:
+                if self._target is None:
+                    self._target = self._factory()
+        return self._target
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self._get(), name)
+
+
+def _make_cohere_client():
+    from openai import OpenAI
+
+    return OpenAI(
+        base_url=cohere_url,
+        api_key=cohere_key,
+    )
+
+
+cohere_client = Lazy(_make_cohere_client)
+
+
+@cache
+def configure_dspy():
+    import dspy
+
+    dspy.configure(
+        lm=dspy.LM(f"openai/{chat_model}", api_key=cohere_key, api_base=cohere_url)
+    )
 
-dspy.configure(
-    lm=dspy.LM(f"openai/{chat_model}", api_key=cohere_key, api_base=cohere_url)
-)
 
 nconf = config["neo4j"]
 
-linkMlStore = LinkMlClient().attach_database(
-    f"neo4j://{nconf.get('username')}:{nconf.get('password')}@{nconf.get('host')}/{nconf.get('database')}",
-    alias="neo4j",
-)
-linkMlDb = linkMlStore.get_collection(nconf.get("database", "neo4j"))
 
-neoDriver = linkMlDb.driver
+def _connect_linkml():
+    from linkml_store import Client as LinkMlClient
+
+    linkMlStore = LinkMlClient().attach_database(
+        f"neo4j://{nconf.get('username')}:{nconf.get('password')}@{nconf.get('host')}/{nconf.get('database')}",
+        alias="neo4j",
+    )
+    return linkMlStore.get_collection(nconf.get("database", "neo4j"))
+
+
+linkMlDb = Lazy(_connect_linkml)
+
+neoDriver = Lazy(lambda: linkMlDb.driver)
 # neoDriver = GraphDatabase().driver(
 #     f"neo4j://{nconf.get('host')}", auth=(nconf.get("username"), nconf.get("password"))
 # )
 
+# Connections the async driver keeps open for request handlers
+NEO4J_POOL_SIZE = config.getint("neo4j", "pool_size", fallback=100)
+# Seconds a request waits for a free connection before failing
+NEO4J_ACQUISITION_TIMEOUT = config.getfloat(
+    "neo4j", "acquisition_timeout", fallback=30.0
+)
+# Seconds before a single query is cancelled by the server
+NEO4J_QUERY_TIMEOUT = config.getfloat("neo4j", "query_timeout", fallback=30.0)
+
+
+def _make_async_driver():
+    from neo4j import AsyncGraphDatabase
+
+    return AsyncGraphDatabase.driver(
+        f"neo4j://{nconf.get('host')}",
+        auth=(nconf.get("username"), nconf.get("password")),
+        max_connection_pool_size=NEO4J_POOL_SIZE,
+        connection_acquisition_timeout=NEO4J_ACQUISITION_TIMEOUT,
+    )
+
+
+asyncNeoDriver = Lazy(_make_async_driver)
+
 os.environ["NEO4J_URI"] = f"neo4j://{nconf.get('host')}"
 os.environ["NEO4J_PASSWORD"] = nconf.get("password")
 os.environ["NEO4J_USERNAME"] = nconf.get("username")
@@ -83,6 +179,10 @@ async def get_embedding_dim():
 
 
 async def initialize_rag():
+    from lightrag import LightRAG
+    from lightrag.kg.shared_storage import initialize_pipeline_status
+    from lightrag.utils import EmbeddingFunc
+
     embedding_dimension = await get_embedding_dim()
     print(f"Detected embedding dimension: {embedding_dimension}")
 
@@ -121,6 +221,25 @@ async def get_rag():
     return _RAG
 
 
-from .storage import create_id_constraints
+async def startup():
+    """Connect to the services and bootstrap the database schema, concurrently,
+    then start compiling the templates in the background."""
+    from .storage import ensure_schema
+
+    loop = asyncio.get_running_loop()
+    schema = loop.run_in_executor(None, ensure_schema)
+    # dspy settings belong to the thread that first configures them
+    configure_dspy()
+    await schema
+    if SIEVE_WARM_UP:
+        from .sieve import warm_up
+
+        # Not awaited: the app serves requests meanwhile, uncompiled templates
+        # are compiled on demand as before
+        loop.run_in_executor(None, warm_up)
+
 
-create_id_constraints()
+async def shutdown():
+    """Close the connections opened by the request handlers."""
+    if asyncNeoDriver._target is not None:
+        await asyncNeoDriver.close()
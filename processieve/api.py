@@ -1,8 +1,25 @@
-from typing import Any, Dict, List
-
-from fastapi import HTTPException, status
-
-from . import linkMlDb
+import asyncio
+import zlib
+from datetime import datetime, timezone
+from enum import Enum
+from typing import Any, Dict, Iterator, List, Literal, Optional, Tuple, Type
+
+from fastapi import Depends, HTTPException, Query, Request, Response, status
+from fastapi.responses import StreamingResponse
+from orjson import OPT_APPEND_NEWLINE, JSONDecodeError, dumps, loads
+from pydantic import BaseModel, TypeAdapter, ValidationError
+
+from . import (
+    INGEST_BATCH_SIZE,
+    JOB_WORKERS,
+    SIEVE_CONCURRENCY,
+    SIEVE_THRESHOLD,
+    SIEVE_WAVE_SIZE,
+)
+from .cache import entity_cache, result_cache
+from .digest import compress_texts
+from .ingest import ingest, parse_ndjson
+from .jobs import JobQueue
 from .main import api_router
 from .models import (
     Case,
@@ -21,8 +38,30 @@ from .models import (
     SituationSchema,
     Skill,
 )
-from .sieve import evaluate_many, evaluate_one
-from .utils import clean, dump, to_optional
+from .rules import get_rule_conditions, rule_scores
+from .sieve import (
+    benchmark_library_sizes,
+    compare_modes,
+    evaluate_many,
+    evaluate_one,
+    evaluate_top_k,
+    invalidate_template,
+    models_by_name,
+    shortlist_recall,
+    warm_up_progress,
+)
+from .storage import (
+    FILTER_OPERATORS,
+    delete_object,
+    find_page,
+    get_object,
+    has_ids,
+    insert_object,
+    iter_objects,
+    load_with_references,
+    update_object,
+)
+from .utils import dump, is_multivalued, models_by_category, to_optional
 
 
 class NotFound(HTTPException):
@@ -39,621 +78,705 @@ class BadRequest(HTTPException):
         super().__init__(status.HTTP_400_BAD_REQUEST, detail, headers)
 
 
-@api_router.get("/organization")
-def get_organizations() -> List[Organization]:
-    res = linkMlDb.find({"category": "Organization"})
-    return clean(res.rows)
+class ListQuery:
+    """Paging and filtering parameters of the collection endpoints.
+
+    Other query parameters filter on properties: `status=current` for equality,
+    or `when__gte=2025-01-01` for ranges (with gt, gte, lt or lte). Times without
+    a timezone are taken as UTC.
+    The total count is returned in the X-Total-Count header, and the cursor to
+    pass as `after` for the next page in X-Next-Cursor."""
+
+    def __init__(
+        self,
+        request: Request,
+        response: Response,
+        after: Optional[str] = None,
+        limit: int = Query(100, ge=1, le=1000),
+        fields: Optional[str] = Query(None, description="Comma-separated fields"),
+    ):
+        self.query_params = request.query_params
+        self.response = response
+        self.after = after
+        self.limit = limit
+        self.fields = fields.split(",") if fields else None
+
+
+async def list_objects(model: Type[BaseModel], q: ListQuery) -> List[Dict[str, Any]]:
+    filters = []
+    for key, value in q.query_params.multi_items():
+        if key in ("after", "limit", "fields"):
+            continue
+        prop, _, op = key.partition("__")
+        field = model.model_fields.get(prop)
+        if not field or is_multivalued(field.annotation):
+            raise BadRequest(f"Cannot filter on {prop}")
+        if op and op not in FILTER_OPERATORS:
+            raise BadRequest(f"Unknown operator {op}")
+        try:
+            value = TypeAdapter(field.annotation).validate_python(value)
+        except ValidationError as e:
+            raise BadRequest(f"Invalid value for {prop}: {e}")
+        if isinstance(value, Enum):
+            value = value.value
+        elif isinstance(value, datetime) and value.tzinfo is None:
+            # Stored times are zoned, and Neo4j does not compare them with local ones
+            value = value.replace(tzinfo=timezone.utc)
+        filters.append((prop, op or "eq", value))
+    for field in q.fields or ():
+        if field not in model.model_fields:
+            raise BadRequest(f"Unknown field {field}")
+    rows, total, next_cursor = await find_page(
+        model.__name__, filters, q.fields, q.after, q.limit
+    )
+    q.response.headers["X-Total-Count"] = str(total)
+    if next_cursor is not None:
+        q.response.headers["X-Next-Cursor"] = next_cursor
+    return rows
+
+
+EXPORT_CHUNK_SIZE = 64 * 1024
+
+
+@api_router.get("/export/{category}")
+def export_objects(
+    category: str, after: Optional[str] = None, compress: bool = False
+) -> StreamingResponse:
+    """Stream all objects of a category as NDJSON, ordered by id.
+
+    An interrupted export can be resumed by passing the last id received as `after`,
+    except for categories without ids, which are exported whole."""
+    if category not in models_by_category():
+        raise NotFound()
+    if after is not None and not has_ids(category):
+        raise BadRequest(f"{category} objects have no id to resume after")
+
+    def chunks() -> Iterator[bytes]:
+        compressor = zlib.compressobj(wbits=31) if compress else None
+        buffer = bytearray()
+        for obj in iter_objects(category, after):
+            # default=str serializes the neo4j temporal types as ISO strings
+            buffer += dumps(obj, default=str, option=OPT_APPEND_NEWLINE)
+            if len(buffer) >= EXPORT_CHUNK_SIZE:
+                yield compressor.compress(buffer) if compressor else bytes(buffer)
+                buffer.clear()
+        if compressor:
+            yield compressor.compress(buffer) + compressor.flush()
+        elif buffer:
+            yield bytes(buffer)
+
+    headers = {"Content-Encoding": "gzip"} if compress else None
+    return StreamingResponse(
+        chunks(), media_type="application/x-ndjson", headers=headers
+    )
+
+
+@api_router.post("/import")
+async def import_objects(
+    request: Request, batch_size: int = Query(INGEST_BATCH_SIZE, ge=1)
+) -> Dict[str, Any]:
+    """Insert objects of any categories, given as a JSON array or as NDJSON.
+
+    Each object needs a `category`. Invalid or duplicate objects are reported by row
+    number and skipped, the others are inserted."""
+    body = await request.body()
+    try:
+        if request.headers.get("content-type", "").startswith("application/x-ndjson"):
+            objects = list(parse_ndjson(body.splitlines()))
+        else:
+            objects = loads(body)
+    except JSONDecodeError as e:
+        raise BadRequest(f"Invalid JSON: {e}")
+    if not isinstance(objects, list):
+        raise BadRequest("Expected a list of objects")
+    return await asyncio.to_thread(ingest, objects, batch_size)
+
+
+@api_router.get("/organization", response_model_exclude_unset=True)
+async def get_organizations(
+    q: ListQuery = Depends(),
+) -> List[to_optional(Organization)]:
+    return await list_objects(Organization, q)
 
 
 @api_router.get("/organization/{id}")
-def get_organization(id: str) -> Organization:
-    res = linkMlDb.find(dict(category="Organization", id=id))
-    if not res.num_rows:
+async def get_organization(id: str) -> Organization:
+    res = await get_object("Organization", id)
+    if res is None:
         raise NotFound()
-    return clean(res.rows[0])
+    return res
 
 
 @api_router.post("/organization")
-def add_organization(obj: Organization) -> Organization:
-    res = linkMlDb.insert(dump(obj))
-    linkMlDb.commit()
-    return res
+async def add_organization(obj: Organization) -> Organization:
+    await insert_object(dump(obj))
+    return obj
 
 
 @api_router.patch("/organization/{id}")
-def update_organization(id: str, obj: to_optional(Organization)) -> Organization:
+async def update_organization(id: str, obj: to_optional(Organization)) -> Organization:
     if id != getattr(obj, "id", id):
         raise BadRequest("Do not change the Id")
-    res = get_organization(id)
-    res.update(obj)
-    res = linkMlDb.update(obj)
-    linkMlDb.commit()
+    res = await get_organization(id)
+    res.update(obj.model_dump(exclude_unset=True))
+    await update_object("Organization", id, dump(Organization(**res)))
     return res
 
 
 @api_router.delete("/organization/{id}")
-def delete_organization(id: str) -> None:
-    res = linkMlDb.find(dict(category="Organization", id=id))
-    if not res.num_rows:
+async def delete_organization(id: str) -> None:
+    if not await delete_object("Organization", id):
         raise NotFound()
-    linkMlDb.delete(res.rows[0])
 
 
-@api_router.get("/case")
-def get_cases() -> List[Case]:
-    res = linkMlDb.find({"category": "Case"})
-    return clean(res.rows)
+@api_router.get("/case", response_model_exclude_unset=True)
+async def get_cases(q: ListQuery = Depends()) -> List[to_optional(Case)]:
+    return await list_objects(Case, q)
 
 
 @api_router.get("/case/{id}")
-def get_case(id: str) -> Case:
-    res = linkMlDb.find(dict(category="Case", id=id))
-    if not res.num_rows:
+async def get_case(id: str) -> Case:
+    res = await get_object("Case", id)
+    if res is None:
         raise NotFound()
-    return clean(res.rows[0])
+    return res
 
 
 @api_router.post("/case")
-def add_case(obj: Case) -> Case:
-    res = linkMlDb.insert(dump(obj))
-    linkMlDb.commit()
-    return res
+async def add_case(obj: Case) -> Case:
+    await insert_object(dump(obj))
+    return obj
 
 
 @api_router.patch("/case/{id}")
-def update_case(id: str, obj: to_optional(Case)) -> Case:
+async def update_case(id: str, obj: to_optional(Case)) -> Case:
     if id != getattr(obj, "id", id):
         raise BadRequest("Do not change the Id")
-    res = get_case(id)
-    res.update(obj)
-    res = linkMlDb.update(obj)
-    linkMlDb.commit()
+    res = await get_case(id)
+    res.update(obj.model_dump(exclude_unset=True))
+    await update_object("Case", id, dump(Case(**res)))
     return res
 
 
 @api_router.delete("/case/{id}")
-def delete_case(id: str) -> None:
-    res = linkMlDb.find(dict(category="Case", id=id))
-    if not res.num_rows:
+async def delete_case(id: str) -> None:
+    if not await delete_object("Case", id):
         raise NotFound()
-    linkMlDb.delete(res.rows[0])
 
 
-@api_router.get("/program_template")
-def get_program_templates() -> List[ProgramTemplate]:
-    res = linkMlDb.find({"category": "ProgramTemplate"})
-    return clean(res.rows)
+@api_router.get("/program_template", response_model_exclude_unset=True)
+async def get_program_templates(
+    q: ListQuery = Depends(),
+) -> List[to_optional(ProgramTemplate)]:
+    return await list_objects(ProgramTemplate, q)
 
 
 @api_router.get("/program_template/{id}")
-def get_program_template(id: str) -> ProgramTemplate:
-    res = linkMlDb.find(dict(category="ProgramTemplate", id=id))
-    if not res.num_rows:
+async def get_program_template(id: str) -> ProgramTemplate:
+    res = await get_object("ProgramTemplate", id)
+    if res is None:
         raise NotFound()
-    return clean(res.rows[0])
+    return res
 
 
 @api_router.post("/program_template")
-def add_program_template(obj: ProgramTemplate) -> ProgramTemplate:
-    res = linkMlDb.insert(dump(obj))
-    linkMlDb.commit()
-    return res
+async def add_program_template(obj: ProgramTemplate) -> ProgramTemplate:
+    await insert_object(dump(obj))
+    return obj
 
 
 @api_router.patch("/program_template/{id}")
-def update_program_template(
+async def update_program_template(
     id: str, obj: to_optional(ProgramTemplate)
 ) -> ProgramTemplate:
     if id != getattr(obj, "id", id):
         raise BadRequest("Do not change the Id")
-    res = get_program_template(id)
-    res.update(obj)
-    res = linkMlDb.update(obj)
-    linkMlDb.commit()
+    res = await get_program_template(id)
+    res.update(obj.model_dump(exclude_unset=True))
+    await update_object("ProgramTemplate", id, dump(ProgramTemplate(**res)))
     return res
 
 
 @api_router.delete("/program_template/{id}")
-def delete_program_template(id: str) -> None:
-    res = linkMlDb.find(dict(category="ProgramTemplate", id=id))
-    if not res.num_rows:
+async def delete_program_template(id: str) -> None:
+    if not await delete_object("ProgramTemplate", id):
         raise NotFound()
-    linkMlDb.delete(res.rows[0])
 
 
-@api_router.get("/report")
-def get_reports() -> List[Report]:
-    res = linkMlDb.find({"category": "Report"})
-    return clean(res.rows)
+@api_router.get("/report", response_model_exclude_unset=True)
+async def get_reports(q: ListQuery = Depends()) -> List[to_optional(Report)]:
+    return await list_objects(Report, q)
 
 
 @api_router.get("/report/{id}")
-def get_report(id: str) -> Report:
-    res = linkMlDb.find(dict(category="Report", id=id))
-    if not res.num_rows:
+async def get_report(id: str) -> Report:
+    res = await get_object("Report", id)
+    if res is None:
         raise NotFound()
-    return clean(res.rows[0])
+    return res
 
 
 @api_router.post("/report")
-def add_report(obj: Report) -> Report:
-    res = linkMlDb.insert(dump(obj))
-    linkMlDb.commit()
-    return res
+async def add_report(obj: Report) -> Report:
+    await insert_object(dump(obj))
+    return obj
 
 
 @api_router.patch("/report/{id}")
-def update_report(id: str, obj: to_optional(Report)) -> Report:
+async def update_report(id: str, obj: to_optional(Report)) -> Report:
     if id != getattr(obj, "id", id):
         raise BadRequest("Do not change the Id")
-    res = get_report(id)
-    res.update(obj)
-    res = linkMlDb.update(obj)
-    linkMlDb.commit()
+    res = await get_report(id)
+    res.update(obj.model_dump(exclude_unset=True))
+    await update_object("Report", id, dump(Report(**res)))
     return res
 
 
 @api_router.delete("/report/{id}")
-def delete_report(id: str) -> None:
-    res = linkMlDb.find(dict(category="Report", id=id))
-    if not res.num_rows:
+async def delete_report(id: str) -> None:
+    if not await delete_object("Report", id):
         raise NotFound()
-    linkMlDb.delete(res.rows[0])
 
 
-@api_router.get("/narrative")
-def get_narratives() -> List[Narrative]:
-    res = linkMlDb.find({"category": "Narrative"})
-    return clean(res.rows)
+@api_router.get("/narrative", response_model_exclude_unset=True)
+async def get_narratives(q: ListQuery = Depends()) -> List[to_optional(Narrative)]:
+    return await list_objects(Narrative, q)
 
 
 @api_router.get("/narrative/{id}")
-def get_narrative(id: str) -> Narrative:
-    res = linkMlDb.find(dict(category="Narrative", id=id))
-    if not res.num_rows:
+async def get_narrative(id: str) -> Narrative:
+    res = await get_object("Narrative", id)
+    if res is None:
         raise NotFound()
-    return clean(res.rows[0])
+    return res
 
 
 @api_router.post("/narrative")
-def add_narrative(obj: Narrative) -> Narrative:
-    res = linkMlDb.insert(dump(obj))
-    linkMlDb.commit()
-    return res
+async def add_narrative(obj: Narrative) -> Narrative:
+    await insert_object(dump(obj))
+    return obj
 
 
 @api_router.patch("/narrative/{id}")
-def update_narrative(id: str, obj: to_optional(Narrative)) -> Narrative:
+async def update_narrative(id: str, obj: to_optional(Narrative)) -> Narrative:
     if id != getattr(obj, "id", id):
         raise BadRequest("Do not change the Id")
-    res = get_narrative(id)
-    res.update(obj)
-    res = linkMlDb.update(obj)
-    linkMlDb.commit()
+    res = await get_narrative(id)
+    res.update(obj.model_dump(exclude_unset=True))
+    await update_object("Narrative", id, dump(Narrative(**res)))
     return res
 
 
 @api_router.delete("/narrative/{id}")
-def delete_narrative(id: str) -> None:
-    res = linkMlDb.find(dict(category="Narrative", id=id))
-    if not res.num_rows:
+async def delete_narrative(id: str) -> None:
+    if not await delete_object("Narrative", id):
         raise NotFound()
-    linkMlDb.delete(res.rows[0])
 
 
-@api_router.get("/criterion")
-def get_criteria() -> List[Organization]:
-    res = linkMlDb.find({"category": "Organization"})
-    return clean(res.rows)
+@api_router.get("/criterion", response_model_exclude_unset=True)
+async def get_criteria(q: ListQuery = Depends()) -> List[to_optional(Organization)]:
+    return await list_objects(Organization, q)
 
 
 @api_router.get("/criterion/{id}")
-def get_criterion(id: str) -> Organization:
-    res = linkMlDb.find(dict(category="Organization", id=id))
-    if not res.num_rows:
+async def get_criterion(id: str) -> Organization:
+    res = await get_object("Organization", id)
+    if res is None:
         raise NotFound()
-    return clean(res.rows[0])
+    return res
 
 
 @api_router.post("/criterion")
-def add_criterion(obj: Organization) -> Organization:
-    res = linkMlDb.insert(dump(obj))
-    linkMlDb.commit()
-    return res
+async def add_criterion(obj: Organization) -> Organization:
+    await insert_object(dump(obj))
+    return obj
 
 
 @api_router.patch("/criterion/{id}")
-def update_criterion(id: str, obj: to_optional(Organization)) -> Organization:
+async def update_criterion(id: str, obj: to_optional(Organization)) -> Organization:
     if id != getattr(obj, "id", id):
         raise BadRequest("Do not change the Id")
-    res = get_criterion(id)
-    res.update(obj)
-    res = linkMlDb.update(obj)
-    linkMlDb.commit()
+    res = await get_criterion(id)
+    res.update(obj.model_dump(exclude_unset=True))
+    await update_object("Organization", id, dump(Organization(**res)))
     return res
 
 
 @api_router.delete("/criterion/{id}")
-def delete_criterion(id: str) -> None:
-    res = linkMlDb.find(dict(category="Organization", id=id))
-    if not res.num_rows:
+async def delete_criterion(id: str) -> None:
+    if not await delete_object("Organization", id):
         raise NotFound()
-    linkMlDb.delete(res.rows[0])
 
 
-@api_router.get("/evaluation")
-def get_evaluations() -> List[Evaluation]:
-    res = linkMlDb.find({"category": "Evaluation"})
-    return clean(res.rows)
+@api_router.get("/evaluation", response_model_exclude_unset=True)
+async def get_evaluations(q: ListQuery = Depends()) -> List[to_optional(Evaluation)]:
+    return await list_objects(Evaluation, q)
 
 
 @api_router.get("/evaluation/{id}")
-def get_evaluation(id: str) -> Evaluation:
-    res = linkMlDb.find(dict(category="Evaluation", id=id))
-    if not res.num_rows:
+async def get_evaluation(id: str) -> Evaluation:
+    res = await get_object("Evaluation", id)
+    if res is None:
         raise NotFound()
-    return clean(res.rows[0])
+    return res
 
 
 @api_router.post("/evaluation")
-def add_evaluation(obj: Evaluation) -> Evaluation:
-    res = linkMlDb.insert(dump(obj))
-    linkMlDb.commit()
-    return res
+async def add_evaluation(obj: Evaluation) -> Evaluation:
+    await insert_object(dump(obj))
+    return obj
 
 
 @api_router.patch("/evaluation/{id}")
-def update_evaluation(id: str, obj: to_optional(Evaluation)) -> Evaluation:
+async def update_evaluation(id: str, obj: to_optional(Evaluation)) -> Evaluation:
     if id != getattr(obj, "id", id):
         raise BadRequest("Do not change the Id")
-    res = get_evaluation(id)
-    res.update(obj)
-    res = linkMlDb.update(obj)
-    linkMlDb.commit()
+    res = await get_evaluation(id)
+    res.update(obj.model_dump(exclude_unset=True))
+    await update_object("Evaluation", id, dump(Evaluation(**res)))
     return res
 
 
 @api_router.delete("/evaluation/{id}")
-def delete_evaluation(id: str) -> None:
-    res = linkMlDb.find(dict(category="Evaluation", id=id))
-    if not res.num_rows:
+async def delete_evaluation(id: str) -> None:
+    if not await delete_object("Evaluation", id):
         raise NotFound()
-    linkMlDb.delete(res.rows[0])
 
 
-@api_router.get("/person")
-def get_persons() -> List[Person]:
-    res = linkMlDb.find({"category": "Person"})
-    return clean(res.rows)
+@api_router.get("/person", response_model_exclude_unset=True)
+async def get_persons(q: ListQuery = Depends()) -> List[to_optional(Person)]:
+    return await list_objects(Person, q)
 
 
 @api_router.get("/person/{id}")
-def get_person(id: str) -> Person:
-    res = linkMlDb.find(dict(category="Person", id=id))
-    if not res.num_rows:
+async def get_person(id: str) -> Person:
+    res = await get_object("Person", id)
+    if res is None:
         raise NotFound()
-    return clean(res.rows[0])
+    return res
 
 
 @api_router.post("/person")
-def add_person(obj: Person) -> Person:
-    res = linkMlDb.insert(dump(obj))
-    linkMlDb.commit()
-    return res
+async def add_person(obj: Person) -> Person:
+    await insert_object(dump(obj))
+    return obj
 
 
 @api_router.patch("/person/{id}")
-def update_person(id: str, obj: to_optional(Person)) -> Person:
+async def update_person(id: str, obj: to_optional(Person)) -> Person:
     if id != getattr(obj, "id", id):
         raise BadRequest("Do not change the Id")
-    res = get_person(id)
-    res.update(obj)
-    res = linkMlDb.update(obj)
-    linkMlDb.commit()
+    res = await get_person(id)
+    res.update(obj.model_dump(exclude_unset=True))
+    await update_object("Person", id, dump(Person(**res)))
     return res
 
 
 @api_router.delete("/person/{id}")
-def delete_person(id: str) -> None:
-    res = linkMlDb.find(dict(category="Person", id=id))
-    if not res.num_rows:
+async def delete_person(id: str) -> None:
+    if not await delete_object("Person", id):
         raise NotFound()
-    linkMlDb.delete(res.rows[0])
 
 
-@api_router.get("/role")
-def get_roles() -> List[Role]:
-    res = linkMlDb.find({"category": "Role"})
-    return clean(res.rows)
+@api_router.get("/role", response_model_exclude_unset=True)
+async def get_roles(q: ListQuery = Depends()) -> List[to_optional(Role)]:
+    return await list_objects(Role, q)
 
 
 @api_router.get("/role/{id}")
-def get_role(id: str) -> Role:
-    res = linkMlDb.find(dict(category="Role", id=id))
-    if not res.num_rows:
+async def get_role(id: str) -> Role:
+    res = await get_object("Role", id)
+    if res is None:
         raise NotFound()
-    return clean(res.rows[0])
+    return res
 
 
 @api_router.post("/role")
-def add_role(obj: Role) -> Role:
-    res = linkMlDb.insert(dump(obj))
-    linkMlDb.commit()
-    return res
+async def add_role(obj: Role) -> Role:
+    await insert_object(dump(obj))
+    return obj
 
 
 @api_router.patch("/role/{id}")
-def update_role(id: str, obj: to_optional(Role)) -> Role:
+async def update_role(id: str, obj: to_optional(Role)) -> Role:
     if id != getattr(obj, "id", id):
         raise BadRequest("Do not change the Id")
-    res = get_role(id)
-    res.update(obj)
-    res = linkMlDb.update(obj)
-    linkMlDb.commit()
+    res = await get_role(id)
+    res.update(obj.model_dump(exclude_unset=True))
+    await update_object("Role", id, dump(Role(**res)))
     return res
 
 
 @api_router.delete("/role/{id}")
-def delete_role(id: str) -> None:
-    res = linkMlDb.find(dict(category="Role", id=id))
-    if not res.num_rows:
+async def delete_role(id: str) -> None:
+    if not await delete_object("Role", id):
         raise NotFound()
-    linkMlDb.delete(res.rows[0])
 
 
-@api_router.get("/report_template")
-def get_report_templates() -> List[ReportTemplate]:
-    res = linkMlDb.find({"category": "ReportTemplate"})
-    return clean(res.rows)
+@api_router.get("/report_template", response_model_exclude_unset=True)
+async def get_report_templates(
+    q: ListQuery = Depends(),
+) -> List[to_optional(ReportTemplate)]:
+    return await list_objects(ReportTemplate, q)
 
 
 @api_router.get("/report_template/{id}")
-def get_report_template(id: str) -> ReportTemplate:
-    res = linkMlDb.find(dict(category="ReportTemplate", id=id))
-    if not res.num_rows:
+async def get_report_template(id: str) -> ReportTemplate:
+    res = await get_object("ReportTemplate", id)
+    if res is None:
         raise NotFound()
-    return clean(res.rows[0])
+    return res
 
 
 @api_router.post("/report_template")
-def add_report_template(obj: ReportTemplate) -> ReportTemplate:
-    res = linkMlDb.insert(dump(obj))
-    linkMlDb.commit()
-    return res
+async def add_report_template(obj: ReportTemplate) -> ReportTemplate:
+    await insert_object(dump(obj))
+    return obj
 
 
 @api_router.patch("/report_template/{id}")
-def update_report_template(id: str, obj: to_optional(ReportTemplate)) -> ReportTemplate:
+async def update_report_template(
+    id: str, obj: to_optional(ReportTemplate)
+) -> ReportTemplate:
     if id != getattr(obj, "id", id):
         raise BadRequest("Do not change the Id")
-    res = get_report_template(id)
-    res.update(obj)
-    res = linkMlDb.update(obj)
-    linkMlDb.commit()
+    res = await get_report_template(id)
+    res.update(obj.model_dump(exclude_unset=True))
+    await update_object("ReportTemplate", id, dump(ReportTemplate(**res)))
+    await asyncio.to_thread(invalidate_template, id, "ReportTemplate")
     return res
 
 
 @api_router.delete("/report_template/{id}")
-def delete_report_template(id: str) -> None:
-    res = linkMlDb.find(dict(category="ReportTemplate", id=id))
-    if not res.num_rows:
+async def delete_report_template(id: str) -> None:
+    if not await delete_object("ReportTemplate", id):
         raise NotFound()
-    linkMlDb.delete(res.rows[0])
+    await asyncio.to_thread(invalidate_template, id, "ReportTemplate")
 
 
-@api_router.get("/rule")
-def get_rules() -> List[Rule]:
-    res = linkMlDb.find({"category": "Rule"})
-    return clean(res.rows)
+@api_router.get("/rule", response_model_exclude_unset=True)
+async def get_rules(q: ListQuery = Depends()) -> List[to_optional(Rule)]:
+    return await list_objects(Rule, q)
 
 
 @api_router.get("/rule/{id}")
-def get_rule(id: str) -> Rule:
-    res = linkMlDb.find(dict(category="Rule", id=id))
-    if not res.num_rows:
+async def get_rule(id: str) -> Rule:
+    res = await get_object("Rule", id)
+    if res is None:
         raise NotFound()
-    return clean(res.rows[0])
+    return res
 
 
 @api_router.post("/rule")
-def add_rule(obj: Rule) -> Rule:
-    res = linkMlDb.insert(dump(obj))
-    linkMlDb.commit()
-    return res
+async def add_rule(obj: Rule) -> Rule:
+    await insert_object(dump(obj))
+    return obj
 
 
 @api_router.patch("/rule/{id}")
-def update_rule(id: str, obj: to_optional(Rule)) -> Rule:
+async def update_rule(id: str, obj: to_optional(Rule)) -> Rule:
     if id != getattr(obj, "id", id):
         raise BadRequest("Do not change the Id")
-    res = get_rule(id)
-    res.update(obj)
-    res = linkMlDb.update(obj)
-    linkMlDb.commit()
+    res = await get_rule(id)
+    res.update(obj.model_dump(exclude_unset=True))
+    await update_object("Rule", id, dump(Rule(**res)))
     return res
 
 
 @api_router.delete("/rule/{id}")
-def delete_rule(id: str) -> None:
-    res = linkMlDb.find(dict(category="Rule", id=id))
-    if not res.num_rows:
+async def delete_rule(id: str) -> None:
+    if not await delete_object("Rule", id):
         raise NotFound()
-    linkMlDb.delete(res.rows[0])
 
 
-@api_router.get("/situation_schema")
-def get_situation_schemas() -> List[SituationSchema]:
-    res = linkMlDb.find({"category": "SituationSchema"})
-    return clean(res.rows)
+@api_router.get("/situation_schema", response_model_exclude_unset=True)
+async def get_situation_schemas(
+    q: ListQuery = Depends(),
+) -> List[to_optional(SituationSchema)]:
+    return await list_objects(SituationSchema, q)
 
 
 @api_router.get("/situation_schema/{id}")
-def get_situation_schema(id: str) -> SituationSchema:
-    res = linkMlDb.find(dict(category="SituationSchema", id=id))
-    if not res.num_rows:
+async def get_situation_schema(id: str) -> SituationSchema:
+    res = await get_object("SituationSchema", id)
+    if res is None:
         raise NotFound()
-    return clean(res.rows[0])
+    return res
 
 
 @api_router.post("/situation_schema")
-def add_situation_schema(obj: SituationSchema) -> SituationSchema:
-    res = linkMlDb.insert(dump(obj))
-    linkMlDb.commit()
-    return res
+async def add_situation_schema(obj: SituationSchema) -> SituationSchema:
+    await insert_object(dump(obj))
+    return obj
 
 
 @api_router.patch("/situation_schema/{id}")
-def update_situation_schema(
+async def update_situation_schema(
     id: str, obj: to_optional(SituationSchema)
 ) -> SituationSchema:
     if id != getattr(obj, "id", id):
         raise BadRequest("Do not change the Id")
-    res = get_situation_schema(id)
-    res.update(obj)
-    res = linkMlDb.update(obj)
-    linkMlDb.commit()
+    res = await get_situation_schema(id)
+    res.update(obj.model_dump(exclude_unset=True))
+    await update_object("SituationSchema", id, dump(SituationSchema(**res)))
+    await asyncio.to_thread(invalidate_template, id, "SituationSchema")
     return res
 
 
 @api_router.delete("/situation_schema/{id}")
-def delete_situation_schema(id: str) -> None:
-    res = linkMlDb.find(dict(category="SituationSchema", id=id))
-    if not res.num_rows:
+async def delete_situation_schema(id: str) -> None:
+    if not await delete_object("SituationSchema", id):
         raise NotFound()
-    linkMlDb.delete(res.rows[0])
+    await asyncio.to_thread(invalidate_template, id, "SituationSchema")
 
 
-@api_router.get("/objective")
-def get_objectives() -> List[Objective]:
-    res = linkMlDb.find({"category": "Objective"})
-    return clean(res.rows)
+@api_router.post("/situation_schema/{id}/rule_scores")
+def get_rule_scores(id: str, situation: Dict[str, Any]) -> Dict[str, float]:
+    """Applicability score of each rule matching a situation described with this schema."""
+    return rule_scores(situation, get_rule_conditions(id))
+
+
+@api_router.get("/objective", response_model_exclude_unset=True)
+async def get_objectives(q: ListQuery = Depends()) -> List[to_optional(Objective)]:
+    return await list_objects(Objective, q)
 
 
 @api_router.get("/objective/{id}")
-def get_objective(id: str) -> Objective:
-    res = linkMlDb.find(dict(category="Objective", id=id))
-    if not res.num_rows:
+async def get_objective(id: str) -> Objective:
+    res = await get_object("Objective", id)
+    if res is None:
         raise NotFound()
-    return clean(res.rows[0])
+    return res
 
 
 @api_router.post("/objective")
-def add_objective(obj: Objective) -> Objective:
-    res = linkMlDb.insert(dump(obj))
-    linkMlDb.commit()
-    return res
+async def add_objective(obj: Objective) -> Objective:
+    await insert_object(dump(obj))
+    return obj
 
 
 @api_router.patch("/objective/{id}")
-def update_objective(id: str, obj: to_optional(Objective)) -> Objective:
+async def update_objective(id: str, obj: to_optional(Objective)) -> Objective:
     if id != getattr(obj, "id", id):
         raise BadRequest("Do not change the Id")
-    res = get_objective(id)
-    res.update(obj)
-    res = linkMlDb.update(obj)
-    linkMlDb.commit()
+    res = await get_objective(id)
+    res.update(obj.model_dump(exclude_unset=True))
+    await update_object("Objective", id, dump(Objective(**res)))
     return res
 
 
 @api_router.delete("/objective/{id}")
-def delete_objective(id: str) -> None:
-    res = linkMlDb.find(dict(category="Objective", id=id))
-    if not res.num_rows:
+async def delete_objective(id: str) -> None:
+    if not await delete_object("Objective", id):
         raise NotFound()
-    linkMlDb.delete(res.rows[0])
 
 
-@api_router.get("/skill")
-def get_skills() -> List[Skill]:
-    res = linkMlDb.find({"category": "Skill"})
-    return clean(res.rows)
+@api_router.get("/skill", response_model_exclude_unset=True)
+async def get_skills(q: ListQuery = Depends()) -> List[to_optional(Skill)]:
+    return await list_objects(Skill, q)
 
 
 @api_router.get("/skill/{id}")
-def get_skill(id: str) -> Skill:
-    res = linkMlDb.find(dict(category="Skill", id=id))
-    if not res.num_rows:
+async def get_skill(id: str) -> Skill:
+    res = await get_object("Skill", id)
+    if res is None:
         raise NotFound()
-    return clean(res.rows[0])
+    return res
 
 
 @api_router.post("/skill")
-def add_skill(obj: Skill) -> Skill:
-    res = linkMlDb.insert(dump(obj))
-    linkMlDb.commit()
-    return res
+async def add_skill(obj: Skill) -> Skill:
+    await insert_object(dump(obj))
+    return obj
 
 
 @api_router.patch("/skill/{id}")
-def update_skill(id: str, obj: to_optional(Skill)) -> Skill:
+async def update_skill(id: str, obj: to_optional(Skill)) -> Skill:
     if id != getattr(obj, "id", id):
         raise BadRequest("Do not change the Id")
-    res = get_skill(id)
-    res.update(obj)
-    res = linkMlDb.update(obj)
-    linkMlDb.commit()
+    res = await get_skill(id)
+    res.update(obj.model_dump(exclude_unset=True))
+    await update_object("Skill", id, dump(Skill(**res)))
     return res
 
 
 @api_router.delete("/skill/{id}")
-def delete_skill(id: str) -> None:
-    res = linkMlDb.find(dict(category="Skill", id=id))
-    if not res.num_rows:
+async def delete_skill(id: str) -> None:
+    if not await delete_object("Skill", id):
         raise NotFound()
-    linkMlDb.delete(res.rows[0])
 
 
-@api_router.get("/situation_condition")
-def get_situation_conditions() -> List[SituationCondition]:
-    res = linkMlDb.find({"category": "SituationCondition"})
-    return clean(res.rows)
+@api_router.get("/situation_condition", response_model_exclude_unset=True)
+async def get_situation_conditions(
+    q: ListQuery = Depends(),
+) -> List[to_optional(SituationCondition)]:
+    return await list_objects(SituationCondition, q)
 
 
 @api_router.get("/situation_condition/{id}")
-def get_situation_condition(id: str) -> SituationCondition:
-    res = linkMlDb.find(dict(category="SituationCondition", id=id))
-    if not res.num_rows:
+async def get_situation_condition(id: str) -> SituationCondition:
+    res = await get_object("SituationCondition", id)
+    if res is None:
         raise NotFound()
-    return clean(res.rows[0])
+    return res
 
 
 @api_router.post("/situation_condition")
-def add_situation_condition(obj: SituationCondition) -> SituationCondition:
-    res = linkMlDb.insert(dump(obj))
-    linkMlDb.commit()
-    return res
+async def add_situation_condition(obj: SituationCondition) -> SituationCondition:
+    await insert_object(dump(obj))
+    return obj
 
 
 @api_router.patch("/situation_condition/{id}")
-def update_situation_condition(
+async def update_situation_condition(
     id: str, obj: to_optional(SituationCondition)
 ) -> SituationCondition:
     if id != getattr(obj, "id", id):
         raise BadRequest("Do not change the Id")
-    res = get_situation_condition(id)
-    res.update(obj)
-    res = linkMlDb.update(obj)
-    linkMlDb.commit()
+    res = await get_situation_condition(id)
+    res.update(obj.model_dump(exclude_unset=True))
+    await update_object("SituationCondition", id, dump(SituationCondition(**res)))
     return res
 
 
 @api_router.delete("/situation_condition/{id}")
-def delete_situation_condition(id: str) -> None:
-    res = linkMlDb.find(dict(category="SituationCondition", id=id))
-    if not res.num_rows:
+async def delete_situation_condition(id: str) -> None:
+    if not await delete_object("SituationCondition", id):
         raise NotFound()
-    linkMlDb.delete(res.rows[0])
 
 
-@api_router.post("/case/{id}/evaluate")
-async def evaluate_case(id: str) -> Case:
-    case = get_case(id)
-    narrative_ids = case.narratives
-    # TODO: Make this into a single query
-    narratives = [get_narrative(nid).description for nid in narrative_ids]
-    if case.brief:
-        brief = get_narrative(case.brief).description
-        prompt1 = f"""This is a description of a client case. First the generic brief:
+NARRATIVE_REFERENCES = dict(authors=("Person", {}))
+CASE_REFERENCES = dict(
+    brief=("Narrative", NARRATIVE_REFERENCES),
+    narratives=("Narrative", NARRATIVE_REFERENCES),
+    selected_template=("ProgramTemplate", {}),
+)
+
+
+async def load_case(id: str) -> Tuple[Case, Dict[str, Any]]:
+    """A case, and its brief, narratives with their authors and selected template."""
+    row = await load_with_references("Case", id, CASE_REFERENCES)
+    if not row:
+        raise NotFound()
+    references = row.pop("_references")
+    return Case(**row), references
+
+
+def narrative_text(narrative: Dict[str, Any]) -> str:
+    authors = ", ".join(p["name"] for p in narrative["_references"]["authors"])
+    content = narrative.get("content") or ""
+    return f"{authors}: {content}" if authors else content
+
+
+async def case_prompt(references: Dict[str, Any]) -> str:
+    """The description of a case sent to the sieve, compressed to fit its token budget."""
+    texts = [narrative_text(n) for n in references["brief"] + references["narratives"]]
+    texts = await compress_texts(texts)
+    brief = [t for t in texts[: len(references["brief"])] if t]
+    narratives = [t for t in texts[len(references["brief"]) :] if t]
+    if brief:
+        brief = "\n\n".join(brief)
+        return f"""This is a description of a client case. First the generic brief:
 
         {brief}
 
@@ -661,16 +784,157 @@ async def evaluate_case(id: str) -> Case:
 
         {"\n\n".join(narratives)}"""
     else:
-        prompt1 = f"""This is a description of a client case. Here is how it was described by various people:
+        return f"""This is a description of a client case. Here is how it was described by various people:
 
         {"\n\n".join(narratives)}"""
 
-    if case.selected_template:
-        case.outcome_analysis = await evaluate_one(prompt1)
+
+@api_router.post("/case/{id}/evaluate")
+async def evaluate_case(id: str, use_cache: bool = True) -> Case:
+    case, references = await load_case(id)
+    prompt1 = await case_prompt(references)
+
+    output = None
+    if references["selected_template"]:
+        output = await evaluate_one(
+            prompt1, case.selected_template, use_cache=use_cache
+        )
     else:
-        results = await evaluate_many(prompt1)
+        if SIEVE_WAVE_SIZE:
+            results, explanation = await evaluate_top_k(
+                prompt1, wave_size=SIEVE_WAVE_SIZE, use_cache=use_cache
+            )
+            print(f"Case {id}: {explanation['reason']}")
+        else:
+            results = await evaluate_many(prompt1, use_cache=use_cache)
         if results:
-            case.outcome_analysis = results[0]
-            case.selected_template = results[1]
-    update_case(id, case)
+            case.selected_template, output, _ = results[0]
+    if output:
+        case.outcome_analysis = output.model_dump_json()
+    await update_object("Case", id, dump(case))
     return case
+
+
+evaluation_jobs = JobQueue(evaluate_case, workers=JOB_WORKERS)
+
+
+class BatchEvaluation(BaseModel):
+    case_ids: List[str] = []
+    organization: Optional[str] = None
+    use_cache: bool = True
+
+
+@api_router.post("/cases/evaluate")
+async def evaluate_cases(batch: BatchEvaluation) -> Dict[str, Any]:
+    """Queue the evaluation of the given cases, and those in the organization's casebook."""
+    case_ids = list(batch.case_ids)
+    if batch.organization:
+        organization = await get_organization(batch.organization)
+        case_ids += organization.get("casebook") or []
+    if not case_ids:
+        raise BadRequest("No cases to evaluate")
+    job = evaluation_jobs.submit(
+        list(dict.fromkeys(case_ids)), use_cache=batch.use_cache
+    )
+    return job.summary()
+
+
+@api_router.get("/jobs/{id}")
+def get_job(id: str) -> Dict[str, Any]:
+    job = evaluation_jobs.jobs.get(id)
+    if not job:
+        raise NotFound()
+    return job.summary()
+
+
+@api_router.get("/jobs/{id}/events")
+def get_job_events(id: str) -> StreamingResponse:
+    """Server-sent events with the result of each case, as they complete."""
+    job = evaluation_jobs.jobs.get(id)
+    if not job:
+        raise NotFound()
+
+    async def stream():
+        async for event in job.follow():
+            yield b"data: " + dumps(event) + b"\n\n"
+        yield b"event: done\ndata: " + dumps(job.summary()) + b"\n\n"
+
+    return StreamingResponse(stream(), media_type="text/event-stream")
+
+
+# The template types the sieve can score
+SieveSchemaType = Literal[tuple(models_by_name)]  # type: ignore
+
+
+@api_router.get("/case/{id}/shortlist_recall")
+async def get_case_shortlist_recall(
+    id: str, k: List[int] = Query([1, 5, 10, 20])
+) -> Dict[int, float]:
+    """Whether the best template for this case is within the embedding shortlist, for each size k."""
+    _, references = await load_case(id)
+    return await shortlist_recall(await case_prompt(references), ks=k)
+
+
+@api_router.get("/case/{id}/top_templates")
+async def get_case_top_templates(
+    id: str,
+    k: int = 1,
+    threshold: float = SIEVE_THRESHOLD,
+    wave_size: int = Query(SIEVE_WAVE_SIZE or SIEVE_CONCURRENCY, gt=0),
+) -> Dict[str, Any]:
+    """The best templates for this case, scored in waves until `k` of them reach `threshold`,
+    and the templates that were skipped."""
+    _, references = await load_case(id)
+    results, explanation = await evaluate_top_k(
+        await case_prompt(references), k=k, threshold=threshold, wave_size=wave_size
+    )
+    return dict(
+        results=[
+            dict(template=sid, confidence=confidence, output=output)
+            for sid, output, confidence in results
+        ],
+        **explanation,
+    )
+
+
+@api_router.get("/case/{id}/sieve_modes")
+async def get_case_sieve_modes(
+    id: str, schema_type: SieveSchemaType = "SituationSchema"
+) -> Dict[str, Dict[str, float]]:
+    """Time and tokens used to score this case against all templates, one per call and packed."""
+    _, references = await load_case(id)
+    return await compare_modes(await case_prompt(references), schema_type)
+
+
+@api_router.get("/case/{id}/sieve_benchmark")
+async def get_case_sieve_benchmark(
+    id: str,
+    schema_type: SieveSchemaType = "SituationSchema",
+    sizes: List[int] = Query([1, 10, 50, 100]),
+    concurrency: int = Query(SIEVE_CONCURRENCY, gt=0),
+) -> Dict[int, Dict[str, float]]:
+    """Time to score this case against the first `sizes` current templates, uncached."""
+    _, references = await load_case(id)
+    return await benchmark_library_sizes(
+        await case_prompt(references), schema_type, sizes, concurrency
+    )
+
+
+@api_router.get("/entity_cache")
+def get_entity_cache_stats() -> Dict[str, Any]:
+    return entity_cache.stats()
+
+
+@api_router.get("/sieve_warm_up")
+def get_sieve_warm_up_progress() -> Dict[str, Any]:
+    return warm_up_progress
+
+
+@api_router.get("/sieve_cache")
+def get_sieve_cache_stats() -> Dict[str, int]:
+    return result_cache.stats()
+
+
+@api_router.delete("/sieve_cache")
+def purge_sieve_cache(template_id: str | None = None) -> int:
+    return result_cache.purge(template_id)
@@ -0,0 +1,194 @@
+import sqlite3
+from collections import OrderedDict
+from hashlib import sha256
+from threading import Lock
+from time import time
+from typing import Any, Dict, Hashable, Optional
+
+from orjson import dumps
+
+from . import Lazy, config
+
+
+class LRUCache:
+    """A thread-safe mapping holding at most `maxsize` entries, least recently used first out."""
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._data: OrderedDict[Hashable, Any] = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            if key not in self._data:
+                return default
+            self._data.move_to_end(key)
+            return self._data[key]
+
+    def __setitem__(self, key: Hashable, value: Any):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            return self._data.pop(key, default)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+class EntityCache:
+    """Database objects by (category, id), kept for `ttl` seconds at most.
+
+    Objects are copied in and out, so callers may modify what they get."""
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = LRUCache(maxsize)
+
+    def get(self, category: str, id: str) -> Optional[Dict[str, Any]]:
+        entry = self._entries.get((category, id))
+        if entry is None or entry[0] < time():
+            self.misses += 1
+            return None
+        self.hits += 1
+        return dict(entry[1])
+
+    def set(self, category: str, id: str, obj: Dict[str, Any]):
+        self._entries[(category, id)] = (time() + self.ttl, dict(obj))
+
+    def invalidate(self, category: str, id: str):
+        self._entries.pop((category, id))
+
+    def clear(self):
+        self._entries.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return dict(
+            entries=len(self._entries),
+            hits=self.hits,
+            misses=self.misses,
+            hit_ratio=self.hits / lookups if lookups else None,
+        )
+
+
+class ResultCache:
+    """A persistent, content-addressed store of LLM evaluation results.
+
+    Entries are keyed by a hash of everything that determines the LLM answer,
+    expire after `ttl` seconds, and the least recently used entries are evicted
+    beyond `max_entries`. Eviction runs every `evict_every` writes, so the cache
+    may briefly hold that many entries more.
+
+    Calls block on SQLite: async code should make them in a worker thread."""
+
+    def __init__(
+        self, path: str, ttl: float, max_entries: int, evict_every: int = 1000
+    ):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.evict_every = evict_every
+        self.hits = 0
+        self.misses = 0
+        self._writes = 0
+        self._lock = Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._conn:
+            self._conn.execute("""CREATE TABLE IF NOT EXISTS results (
+                    key TEXT PRIMARY KEY,
+                    template_id TEXT NOT NULL,
+                    value TEXT NOT NULL,
+                    created REAL NOT NULL,
+                    accessed REAL NOT NULL)""")
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS results_accessed ON results (accessed)"
+            )
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS results_template ON results (template_id)"
+            )
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS results_created ON results (created)"
+            )
+
+    @staticmethod
+    def make_key(prompt: str, schema_def: str, signature: str, model: str) -> str:
+        return sha256(dumps([prompt, schema_def, signature, model])).hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        now = time()
+        with self._lock, self._conn:
+            row = self._conn.execute(
+                "SELECT value FROM results WHERE key = ? AND created > ?",
+                (key, now - self.ttl),
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._conn.execute(
+                "UPDATE results SET accessed = ? WHERE key = ?", (now, key)
+            )
+            return row[0]
+
+    def set(self, key: str, template_id: str, value: str):
+        now = time()
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?)",
+                (key, template_id, value, now, now),
+            )
+            self._writes += 1
+            if self._writes % self.evict_every == 0:
+                self._evict(now)
+
+    def _evict(self, now: float):
+        self._conn.execute("DELETE FROM results WHERE created <= ?", (now - self.ttl,))
+        (entries,) = self._conn.execute("SELECT count(*) FROM results").fetchone()
+        if entries > self.max_entries:
+            self._conn.execute(
+                """DELETE FROM results WHERE key IN (
+                    SELECT key FROM results ORDER BY accessed LIMIT ?)""",
+                (entries - self.max_entries,),
+            )
+
+    def purge(self, template_id: Optional[str] = None) -> int:
+        """Remove the entries of one template, or all entries. Returns the number removed."""
+        with self._lock, self._conn:
+            if template_id:
+                cursor = self._conn.execute(
+                    "DELETE FROM results WHERE template_id = ?", (template_id,)
+                )
+            else:
+                cursor = self._conn.execute("DELETE FROM results")
+            return cursor.rowcount
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            (entries,) = self._conn.execute("SELECT count(*) FROM results").fetchone()
+        return dict(entries=entries, hits=self.hits, misses=self.misses)
+
+
+result_cache = Lazy(
+    lambda: ResultCache(
+        config.get("cache", "path", fallback="sieve_cache.sqlite"),
+        ttl=config.getfloat("cache", "ttl", fallback=7 * 24 * 3600),
+        max_entries=config.getint("cache", "max_entries", fallback=100000),
+    )
+)
+
+# Other workers' writes are only seen once the entry expires, hence the short default
+entity_cache = EntityCache(
+    config.getint("entity_cache", "max_entries", fallback=10000),
+    ttl=config.getfloat("entity_cache", "ttl", fallback=30.0),
+)
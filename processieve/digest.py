@@ -0,0 +1,77 @@
+import asyncio
+from hashlib import sha256
+from typing import List, Optional, Set
+
+from orjson import dumps
+
+from . import CHUNK_TOKEN_SIZE, PROMPT_TOKEN_BUDGET, chat_model, llm_model_func
+from .cache import LRUCache, ResultCache, result_cache
+from .utils import count_tokens, split_tokens
+
+SUMMARY_PROMPT = """Summarize the following part of a client case description in at most a quarter of its length. Keep every fact, name, number and date that could matter to decide how to handle the case, drop repetitions and pleasantries. Answer with the summary only."""
+
+# Texts sharing at least this fraction of their word shingles are considered the same
+DUPLICATE_SIMILARITY = 0.9
+
+# Compressed texts by hash of the originals and budget
+_digest_cache = LRUCache(1000)
+
+
+def _shingles(text: str, size: int = 3) -> Set[tuple]:
+    words = text.lower().split()
+    return {tuple(words[i : i + size]) for i in range(max(len(words) - size + 1, 1))}
+
+
+def drop_near_duplicates(texts: List[str]) -> List[Optional[str]]:
+    """The texts, with None in place of those nearly identical to an earlier one."""
+    kept: List[Set[tuple]] = []
+    result = []
+    for text in texts:
+        shingles = _shingles(text)
+        if any(
+            len(shingles & other) / len(shingles | other) >= DUPLICATE_SIMILARITY
+            for other in kept
+        ):
+            result.append(None)
+        else:
+            kept.append(shingles)
+            result.append(text)
+    return result
+
+
+async def summarize(text: str) -> str:
+    """Summarize a text chunk by chunk, reusing summaries from the result cache."""
+    key = ResultCache.make_key(text, "", SUMMARY_PROMPT, chat_model)
+    summary = await asyncio.to_thread(result_cache.get, key)
+    if summary is None:
+        chunks = split_tokens(text, CHUNK_TOKEN_SIZE)
+        summaries = await asyncio.gather(
+            *[llm_model_func(chunk, system_prompt=SUMMARY_PROMPT) for chunk in chunks]
+        )
+        summary = "\n".join(summaries)
+        await asyncio.to_thread(result_cache.set, key, "summary", summary)
+    return summary
+
+
+async def compress_texts(
+    texts: List[str], budget: int = PROMPT_TOKEN_BUDGET
+) -> List[Optional[str]]:
+    """Fit texts in `budget` tokens: drop near duplicates, then summarize the longest
+    texts until the rest fits. Returns None in place of dropped texts.
+
+    The result may still exceed the budget if the summaries alone do."""
+    key = sha256(dumps([texts, budget])).hexdigest()
+    compressed = _digest_cache.get(key)
+    if compressed is not None:
+        return compressed
+    compressed = drop_near_duplicates(texts)
+    tokens = [count_tokens(t) if t else 0 for t in compressed]
+    for i in sorted(range(len(texts)), key=lambda i: tokens[i], reverse=True):
+        if sum(tokens) <= budget or not tokens[i]:
+            break
+        compressed[i] = await summarize(compressed[i])
+        tokens[i] = count_tokens(compressed[i])
+    if sum(tokens) > budget:
+        print(f"Compressed texts still use {sum(tokens)} tokens out of {budget}")
+    _digest_cache[key] = compressed
+    return compressed
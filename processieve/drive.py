@@ -1,32 +1,291 @@
 # drive.py
+import os
+import random
 import re
-from urllib.parse import parse_qs, urlparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import cache
+from time import monotonic, sleep
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from urllib.parse import parse_qs, urljoin, urlparse
 
+import httplib2
 from google.oauth2 import service_account
-from googleapiclient.discovery import build
+from google_auth_httplib2 import AuthorizedHttp, Request
+from googleapiclient.discovery import Resource, build
 from googleapiclient.errors import HttpError
+from googleapiclient.http import BatchHttpRequest
+from orjson import JSONDecodeError, loads
 
 # Note on scopes: see https://developers.google.com/identity/protocols/oauth2/scopes#drive
 # Experiment with https://developers.google.com/workspace/drive/api/reference/rest/v3/files
 
+# Most calls a Drive HTTP batch request may hold
+BATCH_SIZE = 100
+
+# Calls per second and burst size allowed for each service, within the default
+# per-user quotas: 12,000 Drive queries, 60 Docs and 60 Sheets writes per minute
+RATE_LIMITS = {"drive": (180.0, 100), "docs": (0.9, 5), "sheets": (0.9, 5)}
+# Retries of a throttled or failed call, waiting at most MAX_BACKOFF seconds before each
+MAX_RETRIES = 6
+MAX_BACKOFF = 64.0
+RATE_LIMIT_REASONS = {"rateLimitExceeded", "userRateLimitExceeded"}
+
+
+class TokenBucket:
+    """Lets `rate` calls per second through on average, in bursts of at most `burst`."""
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated = monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, n: int = 1) -> float:
+        """Take `n` tokens, waiting for them if needed. Returns the time waited."""
+        with self._lock:
+            now = monotonic()
+            self._tokens = min(
+                self.burst, self._tokens + (now - self._updated) * self.rate
+            )
+            self._updated = now
+            # Tokens are reserved before waiting, so callers are served in order
+            self._tokens -= min(n, self.burst)
+            wait = max(-self._tokens / self.rate, 0.0)
+        sleep(wait)
+        return wait
+
+
+def is_rate_limited(status: int, content: Any) -> bool:
+    if status == 429:
+        return True
+    if status != 403:
+        return False
+    try:
+        errors = loads(content)["error"].get("errors", [])
+    except (JSONDecodeError, KeyError, TypeError, AttributeError):
+        return False
+    return any(e.get("reason") in RATE_LIMIT_REASONS for e in errors)
+
+
+def is_idempotent(uri: str, method: str) -> bool:
+    """Whether a call can be sent again after a failure that may have applied it."""
+    if method in ("GET", "HEAD", "PUT", "DELETE"):
+        return True
+    # Our creates carry an id from generateIds, so a repeat fails instead of
+    # duplicating the file, and granting a permission twice is harmless.
+    # Batches only hold those calls.
+    path = urlparse(uri).path
+    return path.endswith(("/files", "/permissions")) or "/batch/" in path
+
+
+def _service_of(uri: str) -> str:
+    path = urlparse(uri).path
+    if "/documents" in path:
+        return "docs"
+    if "/spreadsheets" in path:
+        return "sheets"
+    return "drive"
+
+
+def _retry_after(response: Any) -> Optional[float]:
+    try:
+        return float(response.get("retry-after"))
+    except (TypeError, ValueError):
+        # Absent, or an HTTP date, which Google does not send
+        return None
+
+
+class RequestScheduler:
+    """Paces calls to Google APIs under their quotas, and retries those that are
+    throttled or fail, with exponential backoff and jitter, or after the delay the
+    server asks for. Shared by all the threads using the same credentials."""
+
+    def __init__(
+        self,
+        rate_limits: Dict[str, Tuple[float, int]] = RATE_LIMITS,
+        max_retries: int = MAX_RETRIES,
+        max_backoff: float = MAX_BACKOFF,
+    ):
+        self.buckets = {
+            service: TokenBucket(rate, burst)
+            for service, (rate, burst) in rate_limits.items()
+        }
+        self.max_retries = max_retries
+        self.max_backoff = max_backoff
+        self.metrics = dict(
+            calls=0, retries=0, throttled=0, failed=0, waited=0.0, backed_off=0.0
+        )
+        self._lock = threading.Lock()
+
+    def _count(self, **increments):
+        with self._lock:
+            for key, value in increments.items():
+                self.metrics[key] += value
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            return dict(self.metrics)
+
+    def should_retry(self, status: int, content: Any, idempotent: bool) -> bool:
+        """Throttled calls were not applied, and can always be retried."""
+        if is_rate_limited(status, content):
+            self._count(throttled=1)
+            return True
+        return status >= 500 and idempotent
+
+    def backoff(self, attempt: int, retry_after: Optional[float] = None):
+        delay = retry_after
+        if delay is None:
+            delay = random.uniform(0, min(self.max_backoff, 2**attempt))
+        self._count(retries=1, backed_off=delay)
+        sleep(delay)
+
+    def send(self, http: AuthorizedHttp, uri: str, method: str = "GET", **kwargs):
+        """Make an HTTP request to a Google API, as `httplib2.Http.request` does."""
+        body = kwargs.get("body")
+        calls = 1
+        if "/batch/" in uri and isinstance(body, (str, bytes)):
+            # Each call in a batch counts against the quota
+            calls = max(
+                body.count("Content-ID:" if isinstance(body, str) else b"Content-ID:"),
+                1,
+            )
+        bucket = self.buckets[_service_of(uri)]
+        idempotent = is_idempotent(uri, method)
+        for attempt in range(self.max_retries + 1):
+            self._count(calls=calls, waited=bucket.acquire(calls))
+            try:
+                response, content = http.request(uri, method, **kwargs)
+            except (ConnectionError, TimeoutError):
+                if not idempotent or attempt == self.max_retries:
+                    self._count(failed=1)
+                    raise
+                self.backoff(attempt)
+                continue
+            if not self.should_retry(response.status, content, idempotent):
+                return response, content
+            if attempt == self.max_retries:
+                self._count(failed=1)
+                return response, content
+            self.backoff(attempt, _retry_after(response))
+
+
+class ScheduledHttp:
+    """An authorized transport whose requests go through a RequestScheduler."""
+
+    def __init__(self, http: AuthorizedHttp, scheduler: RequestScheduler):
+        self.http = http
+        self.scheduler = scheduler
+
+    def request(self, uri: str, method: str = "GET", **kwargs):
+        return self.scheduler.send(self.http, uri, method, **kwargs)
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self.http, name)
+
+
+class ClientPool:
+    """Google API clients shared by every handler using the same service account.
+
+    Building a client from its discovery document is slow, so each service is built
+    once and shared. httplib2 is not thread-safe though: requests must be executed
+    with `http=pool.http()`, which gives each thread its own authorized transport.
+    The credentials are shared, and refreshed by one thread for all of them.
+    All transports go through the same RequestScheduler."""
+
+    def __init__(self, service_account_file: str, scopes: Tuple[str, ...]):
+        self.credentials = service_account.Credentials.from_service_account_file(
+            service_account_file, scopes=scopes
+        )
+        self._services: Dict[Tuple[str, str, Optional[str]], Resource] = {}
+        self._services_lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+        self._local = threading.local()
+        self.scheduler = RequestScheduler()
+
+    def service(self, name: str, version: str, endpoint: Optional[str] = None):
+        key = (name, version, endpoint)
+        with self._services_lock:
+            if key not in self._services:
+                # static_discovery reads the documents shipped with the client
+                # from disk, instead of fetching them
+                self._services[key] = build(
+                    name,
+                    version,
+                    credentials=self.credentials,
+                    client_options={"api_endpoint": endpoint} if endpoint else None,
+                    static_discovery=True,
+                    cache_discovery=False,
+                )
+            return self._services[key]
+
+    def http(self) -> ScheduledHttp:
+        if not self.credentials.valid:
+            with self._refresh_lock:
+                if not self.credentials.valid:
+                    self.credentials.refresh(Request(httplib2.Http()))
+        http = getattr(self._local, "http", None)
+        if http is None:
+            http = self._local.http = ScheduledHttp(
+                AuthorizedHttp(self.credentials, http=httplib2.Http()), self.scheduler
+            )
+        return http
+
+
+@cache
+def get_client_pool(service_account_file: str, scopes: Tuple[str, ...]) -> ClientPool:
+    return ClientPool(service_account_file, scopes)
+
 
 class GoogleDriveHandler:
     def __init__(
         self,
         service_account_file,
         scopes=["https://www.googleapis.com/auth/drive.readonly"],
+        endpoints: Dict[str, str] = {},
     ):
+        """`endpoints` overrides the root URL of services by name ("drive", "docs",
+        "sheets"), e.g. to run against a local fake server."""
         self.service_account_file = service_account_file
         self.scopes = scopes
+        self.endpoints = endpoints
+        self._file_ids: List[str] = []
+        self._file_ids_lock = threading.Lock()
         self._authenticate()
 
     def _authenticate(self):
-        self.credentials = service_account.Credentials.from_service_account_file(
-            self.service_account_file, scopes=self.scopes
+        self.pool = get_client_pool(
+            os.path.abspath(self.service_account_file), tuple(self.scopes)
+        )
+        self.credentials = self.pool.credentials
+        self.drive_service = self.pool.service(
+            "drive", "v3", self.endpoints.get("drive")
+        )
+        # The client only derives batch URIs from the discovery document
+        self.drive_batch_uri = urljoin(
+            self.endpoints.get("drive", "https://www.googleapis.com/"), "batch/drive/v3"
+        )
+        self.docs_service = self.pool.service("docs", "v1", self.endpoints.get("docs"))
+        self.sheets_service = self.pool.service(
+            "sheets", "v4", self.endpoints.get("sheets")
         )
-        self.drive_service = build("drive", "v3", credentials=self.credentials)
-        self.docs_service = build("docs", "v1", credentials=self.credentials)
-        self.sheets_service = build("sheets", "v4", credentials=self.credentials)
+
+    def _http(self) -> ScheduledHttp:
+        return self.pool.http()
+
+    def _new_file_id(self) -> str:
+        """An id to create a file with, so that a retried create cannot duplicate it."""
+        with self._file_ids_lock:
+            if not self._file_ids:
+                r = (
+                    self.drive_service.files()
+                    .generateIds(count=BATCH_SIZE, space="drive")
+                    .execute(http=self._http())
+                )
+                self._file_ids = r["ids"]
+            return self._file_ids.pop()
 
     def set_folder_from_url(self, folder_url: str):
         """Extract folder ID from shared Google Drive folder URL."""
@@ -51,7 +310,7 @@ class GoogleDriveHandler:
             r = (
                 self.drive_service.files()
                 .get(fileId=self.folder_id, supportsAllDrives=True)
-                .execute()
+                .execute(http=self._http())
             )
             self.drive_id = r["driveId"]
             print(f"✅ Drive ID extracted: {self.drive_id}")
@@ -65,7 +324,9 @@ class GoogleDriveHandler:
             raise ValueError("Folder ID not set. Call set_folder_from_url first.")
 
         print(f"Using folder ID: {self.folder_id}")  # Debug log
+        doc_id = self._new_file_id()
         file_metadata = {
+            "id": doc_id,
             "name": title,
             "parents": [self.folder_id],
             "mimeType": "application/vnd.google-apps.document",
@@ -75,16 +336,15 @@ class GoogleDriveHandler:
         print(file_metadata)
 
         try:
-            doc = (
-                self.drive_service.files()
-                .create(body=file_metadata, supportsAllDrives=True)
-                .execute()
-            )
-            doc_id = doc.get("id")
+            self.drive_service.files().create(
+                body=file_metadata, supportsAllDrives=True
+            ).execute(http=self._http())
             print(f"✅ Document created: {title} (ID: {doc_id})")
         except HttpError as e:
-            print(f"❌ Error creating document: {e}")
-            raise
+            # A retry of a create that went through
+            if e.status_code != 409:
+                print(f"❌ Error creating document: {e}")
+                raise
 
         try:
             insert_text_request = {
@@ -92,7 +352,7 @@ class GoogleDriveHandler:
             }
             self.docs_service.documents().batchUpdate(
                 documentId=doc_id, body=insert_text_request
-            ).execute()
+            ).execute(http=self._http())
             print(f"✍️ Text inserted into the document.")
         except HttpError as e:
             print(f"❌ Error inserting text into document: {e}")
@@ -113,7 +373,9 @@ class GoogleDriveHandler:
             raise ValueError("Folder ID not set. Call set_folder_from_url first.")
 
         print(f"Using folder ID: {self.folder_id}")  # Debug log
+        spreadsheet_id = self._new_file_id()
         spreadsheet = {
+            "id": spreadsheet_id,
             "name": title,
             "parents": [self.folder_id],
             "teamDriveId": self.drive_id,
@@ -126,17 +388,16 @@ class GoogleDriveHandler:
         # }
 
         try:
-            spreadsheet_r = (
-                self.drive_service.files()
-                .create(body=spreadsheet, supportsAllDrives=True)
-                .execute()
-            )
-            spreadsheet_id = spreadsheet_r.get("id")
+            self.drive_service.files().create(
+                body=spreadsheet, supportsAllDrives=True
+            ).execute(http=self._http())
             print(f"✅ Spreadsheet created: {title} (ID: {spreadsheet_id})")
 
         except HttpError as e:
-            print(f"❌ Error creating spreadsheet: {e}")
-            raise
+            # A retry of a create that went through
+            if e.status_code != 409:
+                print(f"❌ Error creating spreadsheet: {e}")
+                raise
 
         if data:
             try:
@@ -149,7 +410,7 @@ class GoogleDriveHandler:
                         valueInputOption="RAW",
                         body={"values": data},
                     )
-                    .execute()
+                    .execute(http=self._http())
                 )
                 print(f"✍️ Data inserted into the spreadsheet at {r['updatedRange']}")
             except HttpError as e:
@@ -165,6 +426,241 @@ class GoogleDriveHandler:
 
         return f"https://docs.google.com/spreadsheets/d/{spreadsheet_id}/edit"
 
+    def _batch(
+        self, requests: List
+    ) -> List[Tuple[Optional[dict], Optional[HttpError]]]:
+        """Execute Drive requests in HTTP batches. Returns (response, error) for each.
+
+        The calls of a batch that are throttled or fail are sent again in later batches.
+        """
+        scheduler = self.pool.scheduler
+        results = [(None, None)] * len(requests)
+        retry_after: List[float] = []
+
+        def callback(request_id, response, exception):
+            results[int(request_id)] = (response, exception)
+            if isinstance(exception, HttpError):
+                request = requests[int(request_id)]
+                if scheduler.should_retry(
+                    exception.status_code,
+                    exception.content,
+                    is_idempotent(request.uri, request.method),
+                ):
+                    pending.append(int(request_id))
+                    retry_after.append(_retry_after(exception.resp) or 0.0)
+
+        pending = list(range(len(requests)))
+        for attempt in range(scheduler.max_retries + 1):
+            if attempt:
+                scheduler.backoff(attempt - 1, max(retry_after) or None)
+            to_send, pending, retry_after[:] = pending, [], []
+            for start in range(0, len(to_send), BATCH_SIZE):
+                batch = BatchHttpRequest(
+                    callback=callback, batch_uri=self.drive_batch_uri
+                )
+                for i in to_send[start : start + BATCH_SIZE]:
+                    batch.add(requests[i], request_id=str(i))
+                batch.execute(http=self._http())
+            if not pending:
+                break
+        return results
+
+    def _create_files(
+        self,
+        mime_type: str,
+        items: List[Tuple[str, object]],
+        fill: Callable[[str, object], None],
+        share_email: str,
+        workers: int,
+    ) -> List[Optional[str]]:
+        """Create files in batches, fill each of them from a pool of `workers` threads,
+        then share them in batches. Returns the file ids, None for those that failed."""
+        if not hasattr(self, "folder_id"):
+            raise ValueError("Folder ID not set. Call set_folder_from_url first.")
+
+        new_ids = [self._new_file_id() for _ in items]
+        created = self._batch(
+            [
+                self.drive_service.files().create(
+                    body={
+                        "id": file_id,
+                        "name": title,
+                        "parents": [self.folder_id],
+                        "mimeType": mime_type,
+                        "teamDriveId": self.drive_id,
+                    },
+                    supportsAllDrives=True,
+                )
+                for file_id, (title, _) in zip(new_ids, items)
+            ]
+        )
+        file_ids = []
+        for file_id, (title, _), (_, error) in zip(new_ids, items, created):
+            # A conflict is a retry of a create that went through
+            if error and error.status_code != 409:
+                print(f"❌ Error creating {title}: {error}")
+                file_id = None
+            file_ids.append(file_id)
+        print(f"✅ {sum(1 for f in file_ids if f)} of {len(items)} files created")
+
+        def fill_one(file_id: Optional[str], content: object) -> Optional[str]:
+            if file_id:
+                try:
+                    fill(file_id, content)
+                    return file_id
+                except HttpError as e:
+                    print(f"❌ Error filling {file_id}: {e}")
+
+        with ThreadPoolExecutor(workers) as pool:
+            file_ids = list(
+                pool.map(fill_one, file_ids, [content for _, content in items])
+            )
+
+        if share_email:
+            permission = {"type": "user", "role": "writer", "emailAddress": share_email}
+            to_share = [file_id for file_id in file_ids if file_id]
+            shared = self._batch(
+                [
+                    self.drive_service.permissions().create(
+                        fileId=file_id, body=permission, fields="id"
+                    )
+                    for file_id in to_share
+                ]
+            )
+            failed = set()
+            for file_id, (_, error) in zip(to_share, shared):
+                if error:
+                    print(f"❌ Error sharing {file_id}: {error}")
+                    failed.add(file_id)
+            file_ids = [None if f in failed else f for f in file_ids]
+            print(f"📤 {len(to_share) - len(failed)} files shared with: {share_email}")
+        return file_ids
+
+    def _insert_text(self, doc_id: str, text: str):
+        self.docs_service.documents().batchUpdate(
+            documentId=doc_id,
+            body={
+                "requests": [{"insertText": {"location": {"index": 1}, "text": text}}]
+            },
+        ).execute(http=self._http())
+
+    def _insert_data(self, spreadsheet_id: str, data: list):
+        if data:
+            self.sheets_service.spreadsheets().values().update(
+                spreadsheetId=spreadsheet_id,
+                range="A1",
+                valueInputOption="RAW",
+                body={"values": data},
+            ).execute(http=self._http())
+
+    def create_documents(
+        self,
+        documents: List[Tuple[str, str]],
+        share_email: str = None,
+        workers: int = 8,
+    ) -> List[Optional[str]]:
+        """Create Google Docs from (title, text) pairs, like `create_document` but with
+        batched Drive calls. Returns their URLs, None for those that failed."""
+        doc_ids = self._create_files(
+            "application/vnd.google-apps.document",
+            documents,
+            self._insert_text,
+            share_email,
+            workers,
+        )
+        return [
+            f"https://docs.google.com/document/d/{doc_id}/edit" if doc_id else None
+            for doc_id in doc_ids
+        ]
+
+    def create_spreadsheets(
+        self, sheets: List[Tuple[str, list]], share_email: str = None, workers: int = 8
+    ) -> List[Optional[str]]:
+        """Create Google Sheets from (title, data) pairs, like `create_spreadsheet` but
+        with batched Drive calls. Returns their URLs, None for those that failed."""
+        spreadsheet_ids = self._create_files(
+            "application/vnd.google-apps.spreadsheet",
+            sheets,
+            self._insert_data,
+            share_email,
+            workers,
+        )
+        return [
+            (
+                f"https://docs.google.com/spreadsheets/d/{spreadsheet_id}/edit"
+                if spreadsheet_id
+                else None
+            )
+            for spreadsheet_id in spreadsheet_ids
+        ]
+
+    def list_folder_files(self, fields: str = "id, name, mimeType, modifiedTime"):
+        """Yield all the files in the folder, page by page."""
+        page_token = None
+        while True:
+            r = (
+                self.drive_service.files()
+                .list(
+                    q=f"'{self.folder_id}' in parents and trashed = false",
+                    fields=f"nextPageToken, files({fields})",
+                    driveId=self.drive_id,
+                    corpora="drive",
+                    includeItemsFromAllDrives=True,
+                    supportsAllDrives=True,
+                    pageSize=1000,
+                    pageToken=page_token,
+                )
+                .execute(http=self._http())
+            )
+            yield from r.get("files", [])
+            page_token = r.get("nextPageToken")
+            if not page_token:
+                return
+
+    def get_start_page_token(self) -> str:
+        """The token from which `list_changes` reports changes made from now on."""
+        r = (
+            self.drive_service.changes()
+            .getStartPageToken(driveId=self.drive_id, supportsAllDrives=True)
+            .execute(http=self._http())
+        )
+        return r["startPageToken"]
+
+    def list_changes(
+        self,
+        page_token: str,
+        fields: str = "id, name, mimeType, modifiedTime, parents, trashed",
+    ) -> Tuple[List[dict], str]:
+        """All the changes to the shared drive since `page_token`, and the token to
+        pass next time."""
+        changes = []
+        while True:
+            r = (
+                self.drive_service.changes()
+                .list(
+                    pageToken=page_token,
+                    driveId=self.drive_id,
+                    includeItemsFromAllDrives=True,
+                    supportsAllDrives=True,
+                    fields=f"nextPageToken, newStartPageToken, changes(fileId, removed, file({fields}))",
+                    pageSize=1000,
+                )
+                .execute(http=self._http())
+            )
+            changes += r.get("changes", [])
+            if "newStartPageToken" in r:
+                return changes, r["newStartPageToken"]
+            page_token = r["nextPageToken"]
+
+    def export_text(self, file_id: str) -> str:
+        """The content of a Google Doc as plain text."""
+        content = (
+            self.drive_service.files()
+            .export(fileId=file_id, mimeType="text/plain")
+            .execute(http=self._http())
+        )
+        return content.decode("utf-8-sig")
+
     def check_folder_access(self):
         """Check if the folder is accessible by listing its contents."""
         try:
@@ -178,7 +674,7 @@ class GoogleDriveHandler:
                     supportsAllDrives=True,
                     pageSize=10,
                 )
-                .execute()
+                .execute(http=self._http())
             )
             print(f"✅ Folder accessible. Files in folder: {files.get('files', [])}")
 
@@ -200,7 +696,7 @@ class GoogleDriveHandler:
         try:
             self.drive_service.permissions().create(
                 fileId=file_id, body=permission, fields="id"
-            ).execute()
+            ).execute(http=self._http())
             print(f"📤 File shared with: {email}")
         except HttpError as e:
             print(f"❌ Error sharing file: {e}")
@@ -0,0 +1,125 @@
+import argparse
+from typing import Any, Dict, List
+
+from . import neoDriver
+from .cache import entity_cache
+from .drive import GoogleDriveHandler
+from .models import Narrative, Status
+from .storage import get_drive_page_token, set_drive_page_token
+from .utils import dump
+
+DOCUMENT_MIME_TYPE = "application/vnd.google-apps.document"
+
+
+def narrative_id(file_id: str) -> str:
+    return f"gdrive:{file_id}"
+
+
+def _known_versions(file_ids: List[str]) -> Dict[str, Any]:
+    """The modification time of the narratives already synced from these files."""
+    records, _, _ = neoDriver.execute_query(
+        "MATCH (n:Narrative) WHERE n.id IN $ids RETURN n.id AS id, n.when AS when",
+        ids=[narrative_id(f) for f in file_ids],
+    )
+    return {r["id"]: r["when"].to_native() for r in records}
+
+
+def _save_narratives(case_id: str, narratives: List[Narrative]):
+    """Upsert the narratives, and add those missing from the case to it."""
+    rows = [
+        {k: v for k, v in dump(n).items() if k != "category" and v is not None}
+        for n in narratives
+    ]
+    ids = [n.id for n in narratives]
+    neoDriver.execute_query(
+        """UNWIND $rows AS row
+        MERGE (n:Narrative {id: row.id}) SET n += row""",
+        rows=rows,
+    )
+    neoDriver.execute_query(
+        """MATCH (c:Case {id: $case_id})
+        SET c.narratives = coalesce(c.narratives, [])
+            + [id IN $ids WHERE NOT id IN coalesce(c.narratives, [])]""",
+        case_id=case_id,
+        ids=ids,
+    )
+    for id in ids:
+        entity_cache.invalidate("Narrative", id)
+    entity_cache.invalidate("Case", case_id)
+
+
+def sync_folder(
+    handler: GoogleDriveHandler, case_id: str, batch_size: int = 100
+) -> Dict[str, int]:
+    """Import the Google Docs of the handler's folder as narratives of a case.
+
+    The first sync lists the whole folder, and skips the docs whose narrative is
+    up to date. Later syncs only look at the changes to the drive since the last one,
+    using the Drive changes token saved in the database. Deleted docs are left alone.
+    """
+    records, _, _ = neoDriver.execute_query(
+        "MATCH (c:Case {id: $case_id}) RETURN count(c) AS found", case_id=case_id
+    )
+    if not records[0]["found"]:
+        raise ValueError(f"Unknown case {case_id}")
+    folder_id = handler.folder_id
+    page_token = get_drive_page_token(folder_id)
+    # Taken before listing, so that changes made meanwhile are seen next time
+    next_token = handler.get_start_page_token() if page_token is None else None
+    if page_token is None:
+        files = list(handler.list_folder_files())
+    else:
+        changes, next_token = handler.list_changes(page_token)
+        files = {
+            change["fileId"]: change["file"]
+            for change in changes
+            # Shared drive feeds also report changes to the drive itself, without a file
+            if change.get("file")
+            and not change.get("removed")
+            and not change["file"].get("trashed")
+            and folder_id in change["file"].get("parents", [])
+        }.values()
+    docs = [f for f in files if f["mimeType"] == DOCUMENT_MIME_TYPE]
+    known = _known_versions([doc["id"] for doc in docs])
+    stats = dict(seen=len(docs), imported=0, unchanged=0)
+    batch: List[Narrative] = []
+    for doc in docs:
+        narrative = Narrative(
+            id=narrative_id(doc["id"]),
+            title=doc["name"],
+            when=doc["modifiedTime"],
+            status=Status.current,
+            content=None,
+        )
+        if known.get(narrative.id) == narrative.when:
+            stats["unchanged"] += 1
+            continue
+        narrative.content = handler.export_text(doc["id"])
+        batch.append(narrative)
+        if len(batch) >= batch_size:
+            _save_narratives(case_id, batch)
+            stats["imported"] += len(batch)
+            batch = []
+    if batch:
+        _save_narratives(case_id, batch)
+        stats["imported"] += len(batch)
+    set_drive_page_token(folder_id, next_token)
+    return stats
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Import the Google Docs of a Drive folder as narratives of a case"
+    )
+    parser.add_argument("service_account_file")
+    parser.add_argument("folder_url")
+    parser.add_argument("case_id")
+    args = parser.parse_args()
+    handler = GoogleDriveHandler(
+        args.service_account_file, ["https://www.googleapis.com/auth/drive.readonly"]
+    )
+    handler.set_folder_from_url(args.folder_url)
+    stats = sync_folder(handler, args.case_id)
+    print(
+        f"Imported {stats['imported']} of {stats['seen']} docs, {stats['unchanged']} unchanged"
+    )
@@ -77,15 +77,18 @@ def show():
             ),
         )
 
+        ui.button("Cancel Drive operations", on_click=state.cancel_tasks).props(
+            "outline"
+        )
+
     with ui.footer().style("background-color: #000000"):
         ui.label("Marc-Antoine, Eden, Dave")
     mode.enable()
 
 
-def on_set_folder_url(folder_url: str):
+async def on_set_folder_url(folder_url: str):
     """Handle setting the folder URL and checking access."""
-    state.set_folder_url(folder_url)
-    state.drive_handler.check_folder_access()  # Add this line to check folder access after setting the URL
+    await state.set_folder_url(folder_url)
 
 
 ui.run_with(
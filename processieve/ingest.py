@@ -0,0 +1,126 @@
+import argparse
+from itertools import groupby
+from typing import Any, Dict, Iterable, Iterator, List, Tuple
+
+from neo4j.exceptions import ConstraintError
+from orjson import loads
+from pydantic import ValidationError
+
+from . import INGEST_BATCH_SIZE, neoDriver
+from .utils import dump, models_by_category
+
+# (row number, error message)
+RowError = Tuple[int, str]
+
+
+def validate_objects(
+    objects: Iterable[Dict[str, Any]],
+) -> Iterator[Tuple[int, Dict[str, Any] | None, str | None]]:
+    """Validate each object against the model named by its category.
+
+    Yields (row number, row to store or None, error or None)."""
+    models = models_by_category()
+    for i, obj in enumerate(objects):
+        if not isinstance(obj, dict):
+            yield i, None, "Not an object"
+            continue
+        obj = dict(obj)
+        category = obj.pop("category", None)
+        info = models.get(category) if isinstance(category, str) else None
+        if not info:
+            yield i, None, "Missing or unknown category"
+            continue
+        try:
+            yield i, dump(info.model(**obj)), None
+        except ValidationError as e:
+            yield i, None, str(e)
+
+
+def _insert_batch(
+    category: str, batch: List[Tuple[int, Dict]]
+) -> Tuple[int, List[RowError]]:
+    """Insert a batch of objects of a category. Returns how many were inserted, and the
+    rows whose id was taken."""
+    query = f"UNWIND $rows AS row CREATE (n:{category}) SET n = row"
+    rows = [(i, {k: v for k, v in row.items() if k != "category"}) for i, row in batch]
+    if "id" not in models_by_category()[category].model.model_fields:
+        # Nothing can clash without ids
+        neoDriver.execute_query(query, rows=[row for _, row in rows])
+        return len(rows), []
+    errors = []
+    records, _, _ = neoDriver.execute_query(
+        f"MATCH (n:{category}) WHERE n.id IN $ids RETURN n.id AS id",
+        ids=[row["id"] for _, row in rows],
+    )
+    taken = {r["id"] for r in records}
+    new_rows = []
+    for i, row in rows:
+        if row["id"] in taken:
+            errors.append((i, f"{category} {row['id']} already exists"))
+        else:
+            taken.add(row["id"])
+            new_rows.append((i, row))
+    try:
+        neoDriver.execute_query(query, rows=[row for _, row in new_rows])
+    except ConstraintError:
+        # Lost a race with another writer: find the culprits one by one
+        for i, row in new_rows:
+            try:
+                neoDriver.execute_query(query, rows=[row])
+            except ConstraintError as e:
+                errors.append((i, e.message))
+    return len(batch) - len(errors), errors
+
+
+def ingest(
+    objects: Iterable[Dict[str, Any]], batch_size: int = INGEST_BATCH_SIZE
+) -> Dict[str, Any]:
+    """Validate and insert objects of any categories, in batched transactions.
+
+    Rows that fail are reported and skipped, without aborting the rest of their batch.
+    """
+    errors: List[RowError] = []
+    valid = []
+    for i, row, error in validate_objects(objects):
+        if error:
+            errors.append((i, error))
+        else:
+            valid.append((i, row))
+    # Objects only need to be grouped by category, keep the input order otherwise
+    valid.sort(key=lambda x: x[1]["category"])
+    inserted = 0
+    for category, group in groupby(valid, key=lambda x: x[1]["category"]):
+        group = list(group)
+        for start in range(0, len(group), batch_size):
+            batch = group[start : start + batch_size]
+            batch_inserted, batch_errors = _insert_batch(category, batch)
+            inserted += batch_inserted
+            errors.extend(batch_errors)
+    return dict(
+        inserted=inserted,
+        errors=[dict(row=i, error=e) for i, e in sorted(errors)],
+    )
+
+
+def parse_ndjson(lines: Iterable[bytes | str]) -> Iterator[Dict[str, Any]]:
+    for line in lines:
+        if line.strip():
+            yield loads(line)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Load objects into the database from NDJSON or a JSON array"
+    )
+    parser.add_argument("file")
+    parser.add_argument("--batch-size", type=int, default=INGEST_BATCH_SIZE)
+    args = parser.parse_args()
+    with open(args.file, "rb") as f:
+        if args.file.endswith(".ndjson") or args.file.endswith(".jsonl"):
+            objects = list(parse_ndjson(f))
+        else:
+            objects = loads(f.read())
+    result = ingest(objects, args.batch_size)
+    for error in result["errors"]:
+        print(f"Row {error['row']}: {error['error']}")
+    print(f"Inserted {result['inserted']} objects, {len(result['errors'])} errors")
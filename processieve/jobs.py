@@ -0,0 +1,95 @@
+import asyncio
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional
+from uuid import uuid4
+
+from fastapi.encoders import jsonable_encoder
+
+from .cache import LRUCache
+
+
+class Job:
+    """A batch of items processed by a JobQueue, with the events emitted so far."""
+
+    def __init__(self, items: List[str]):
+        self.id = uuid4().hex
+        self.items = items
+        self.pending = len(items)
+        self.events: List[Dict[str, Any]] = []
+        self._changed = asyncio.Condition()
+
+    @property
+    def done(self) -> bool:
+        return self.pending == 0
+
+    def summary(self) -> Dict[str, Any]:
+        return dict(
+            job_id=self.id,
+            total=len(self.items),
+            pending=self.pending,
+            failed=sum(1 for e in self.events if "error" in e),
+        )
+
+    async def _emit(self, event: Dict[str, Any]):
+        async with self._changed:
+            self.events.append(event)
+            self.pending -= 1
+            self._changed.notify_all()
+
+    async def follow(self) -> AsyncIterator[Dict[str, Any]]:
+        """Yield the events emitted so far, then the others as they come, until the job is done."""
+        seen = 0
+        while True:
+            async with self._changed:
+                await self._changed.wait_for(
+                    lambda: len(self.events) > seen or self.done
+                )
+                new_events = self.events[seen:]
+            for event in new_events:
+                yield event
+            seen += len(new_events)
+            if self.done and seen == len(self.events):
+                return
+
+
+class JobQueue:
+    """Runs `handler` on each item of submitted jobs, with a fixed pool of workers."""
+
+    def __init__(
+        self,
+        handler: Callable[..., Awaitable[Any]],
+        workers: int,
+        max_jobs: int = 1000,
+    ):
+        self.handler = handler
+        self.workers = workers
+        self.jobs = LRUCache(max_jobs)
+        self._queue: Optional[asyncio.Queue] = None
+        self._tasks: List[asyncio.Task] = []
+
+    def _start(self):
+        # Created lazily, as they need the running event loop
+        if self._queue is None:
+            self._queue = asyncio.Queue()
+            self._tasks = [
+                asyncio.create_task(self._work()) for _ in range(self.workers)
+            ]
+
+    async def _work(self):
+        while True:
+            job, item, kwargs = await self._queue.get()
+            try:
+                result = await self.handler(item, **kwargs)
+                event = dict(item=item, result=jsonable_encoder(result))
+            except Exception as e:
+                event = dict(item=item, error=str(e))
+            await job._emit(event)
+            self._queue.task_done()
+
+    def submit(self, items: List[str], **kwargs) -> Job:
+        """Queue a job over the items; `kwargs` are passed to the handler for each."""
+        self._start()
+        job = Job(items)
+        self.jobs[job.id] = job
+        for item in items:
+            self._queue.put_nowait((job, item, kwargs))
+        return job
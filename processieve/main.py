@@ -1,18 +1,28 @@
+from contextlib import asynccontextmanager
+
 from fastapi import FastAPI, APIRouter
 
-app = FastAPI()
+from processieve import shutdown, startup
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await startup()
+    yield
+    await shutdown()
+
+
+app = FastAPI(lifespan=lifespan)
 
 api_router = APIRouter(
     prefix="/api",
 )
 import processieve.api
 
-
 app.include_router(api_router)
 
 import processieve.frontend
 
-
 if __name__ == "__main__":
     print(
         'Please start the app with the "uvicorn" command as shown in the start.sh script'
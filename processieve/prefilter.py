@@ -0,0 +1,138 @@
+import asyncio
+import os
+from hashlib import sha256
+from threading import Lock
+from typing import Dict, List, Optional, Set
+
+import numpy as np
+from nano_vectordb import NanoVectorDB
+
+from . import EMBEDDING_BATCH_SIZE, config, embedding_func, neoDriver
+
+TEMPLATE_INDEX_FILE = config.get(
+    "sieve", "template_index", fallback="template_index.json"
+)
+
+_index: Optional[NanoVectorDB] = None
+# The index is loaded, updated, saved and queried in worker threads, one at a time
+_index_lock = Lock()
+
+
+def get_template_index(embedding_dim: int) -> NanoVectorDB:
+    """The template index, loaded from its file on first use. Hold `_index_lock`."""
+    global _index
+    if _index is None:
+        _index = NanoVectorDB(embedding_dim, storage_file=TEMPLATE_INDEX_FILE)
+    return _index
+
+
+def _save_index(index: NanoVectorDB):
+    # Write aside then rename, so other workers never load a half written file
+    tmp = f"{TEMPLATE_INDEX_FILE}.{os.getpid()}.tmp"
+    index.storage_file = tmp
+    try:
+        index.save()
+    finally:
+        index.storage_file = TEMPLATE_INDEX_FILE
+    os.replace(tmp, TEMPLATE_INDEX_FILE)
+
+
+def _stale_templates(
+    digests: Dict[str, str], schema_type: str, embedding_dim: int
+) -> List[str]:
+    with _index_lock:
+        index = get_template_index(embedding_dim)
+        known = {
+            d["template_id"]: d["digest"]
+            for d in index.get({f"{schema_type}:{tid}" for tid in digests})
+        }
+    return [tid for tid, digest in digests.items() if known.get(tid) != digest]
+
+
+def _store_vectors(
+    vectors: Dict[str, np.ndarray],
+    digests: Dict[str, str],
+    schema_type: str,
+    embedding_dim: int,
+):
+    with _index_lock:
+        index = get_template_index(embedding_dim)
+        index.upsert(
+            [
+                {
+                    "__id__": f"{schema_type}:{tid}",
+                    "__vector__": vector,
+                    "template_id": tid,
+                    "schema_type": schema_type,
+                    "digest": digests[tid],
+                }
+                for tid, vector in vectors.items()
+            ]
+        )
+        _save_index(index)
+
+
+def template_texts(rows: List[Dict]) -> Dict[str, str]:
+    """The text embedded for each template: its narrative followed by its schema."""
+    narrative_ids = [row["narrative"] for row in rows if row.get("narrative")]
+    records, _, _ = neoDriver.execute_query(
+        "MATCH (n:Narrative) WHERE n.id IN $ids RETURN n.id, n.title, n.content",
+        ids=narrative_ids,
+    )
+    narratives = {
+        nid: "\n\n".join(filter(None, (title, content)))
+        for nid, title, content in records
+    }
+    return {
+        row["id"]: "\n\n".join(
+            filter(None, (narratives.get(row.get("narrative")), row.get("schema_def")))
+        )
+        for row in rows
+    }
+
+
+async def index_templates(rows: List[Dict], schema_type: str, embedding_dim: int):
+    """Embed the templates that are missing from the index or changed since they were indexed."""
+    texts = await asyncio.to_thread(template_texts, rows)
+    digests = {tid: sha256(text.encode()).hexdigest() for tid, text in texts.items()}
+    stale = await asyncio.to_thread(
+        _stale_templates, digests, schema_type, embedding_dim
+    )
+    if stale:
+        batches = [
+            [texts[tid] for tid in stale[i : i + EMBEDDING_BATCH_SIZE]]
+            for i in range(0, len(stale), EMBEDDING_BATCH_SIZE)
+        ]
+        vectors = np.concatenate(
+            await asyncio.gather(*[embedding_func(batch) for batch in batches])
+        )
+        await asyncio.to_thread(
+            _store_vectors,
+            dict(zip(stale, vectors)),
+            digests,
+            schema_type,
+            embedding_dim,
+        )
+
+
+def _query_index(
+    query: np.ndarray, ids: Set[str], schema_type: str, k: int
+) -> List[str]:
+    with _index_lock:
+        hits = get_template_index(query.shape[0]).query(
+            query,
+            top_k=k,
+            filter_lambda=lambda d: d["schema_type"] == schema_type
+            and d["template_id"] in ids,
+        )
+    return [hit["template_id"] for hit in hits]
+
+
+async def shortlist_templates(
+    text: str, rows: List[Dict], schema_type: str, k: int
+) -> List[str]:
+    """Ids of the `k` templates among `rows` whose embedding is nearest to the text."""
+    query: np.ndarray = (await embedding_func([text]))[0]
+    await index_templates(rows, schema_type, query.shape[0])
+    ids = {row["id"] for row in rows}
+    return await asyncio.to_thread(_query_index, query, ids, schema_type, k)
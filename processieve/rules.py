@@ -0,0 +1,139 @@
+from typing import Any, Dict, FrozenSet, List, Optional, Tuple
+
+import numpy as np
+from orjson import JSONDecodeError, loads
+
+from . import neoDriver
+from .cache import LRUCache
+
+Ranges = Dict[str, Tuple[float, float]]
+Lists = Dict[str, FrozenSet]
+
+
+class CompiledCondition:
+    """A `SituationCondition.condition` parsed into ordered clauses of interval and
+    membership checks, so applicability can be decided without calling the LLM."""
+
+    def __init__(self, clauses: List[Tuple[Ranges, Lists, float]]):
+        self.clauses = clauses
+
+    @classmethod
+    def parse(cls, condition: str) -> "CompiledCondition":
+        try:
+            data = loads(condition)
+        except JSONDecodeError as e:
+            raise ValueError(f"Condition is not valid JSON: {e}")
+        if not isinstance(data, list):
+            raise ValueError("Condition should be a list of clauses")
+        clauses = []
+        for n, clause in enumerate(data):
+            try:
+                ranges = {
+                    attr: (float(low), float(high))
+                    for attr, (low, high) in clause.get("ranges", {}).items()
+                }
+                lists = {
+                    attr: frozenset(values)
+                    for attr, values in clause.get("lists", {}).items()
+                }
+                clauses.append((ranges, lists, float(clause["score"])))
+            except (AttributeError, KeyError, TypeError, ValueError) as e:
+                raise ValueError(f"Invalid clause {n}: {e!r}")
+        return cls(clauses)
+
+    def match(self, situation: Dict[str, Any]) -> Optional[float]:
+        """The score of the first clause the situation satisfies, if any."""
+        for ranges, lists, score in self.clauses:
+            if all(
+                isinstance(situation.get(attr), (int, float))
+                and low <= situation[attr] <= high
+                for attr, (low, high) in ranges.items()
+            ) and all(
+                _is_in(situation.get(attr), values) for attr, values in lists.items()
+            ):
+                return score
+        return None
+
+    def match_many(self, situations: List[Dict[str, Any]]) -> np.ndarray:
+        """Scores of the first satisfied clause for each situation, NaN where none is."""
+        n = len(situations)
+        scores = np.full(n, np.nan)
+        pending = np.ones(n, dtype=bool)
+        numeric: Dict[str, np.ndarray] = {}
+        for ranges, lists, score in self.clauses:
+            mask = pending.copy()
+            for attr, (low, high) in ranges.items():
+                if attr not in numeric:
+                    numeric[attr] = np.array(
+                        [_as_number(s.get(attr)) for s in situations], dtype=float
+                    )
+                # NaN comparisons are False, so missing values never match
+                mask &= (numeric[attr] >= low) & (numeric[attr] <= high)
+            for attr, values in lists.items():
+                mask &= np.fromiter(
+                    (_is_in(s.get(attr), values) for s in situations),
+                    dtype=bool,
+                    count=n,
+                )
+            scores[mask] = score
+            pending &= ~mask
+            if not pending.any():
+                break
+        return scores
+
+
+def _is_in(value: Any, values: FrozenSet) -> bool:
+    # Answers may be lists or objects, which can never be members
+    try:
+        return value in values
+    except TypeError:
+        return False
+
+
+def _as_number(value: Any) -> float:
+    if isinstance(value, (int, float)):
+        return float(value)
+    return np.nan
+
+
+# Keyed by the condition text itself, so edits never see a stale compilation
+_condition_cache = LRUCache(10000)
+
+
+def compile_condition(condition: str) -> CompiledCondition:
+    compiled = _condition_cache.get(condition)
+    if compiled is None:
+        compiled = CompiledCondition.parse(condition)
+        _condition_cache[condition] = compiled
+    return compiled
+
+
+def get_rule_conditions(situation_schema: str) -> Dict[str, CompiledCondition]:
+    """The compiled condition of every current rule that applies to a situation schema.
+
+    Rules whose condition does not parse are left out."""
+    records, _, _ = neoDriver.execute_query(
+        """MATCH (r:Rule) WHERE r.superseded_by IS NULL
+        MATCH (c:SituationCondition {id: r.situation_condition, situation_schema: $schema})
+        RETURN r.id, c.condition""",
+        schema=situation_schema,
+    )
+    conditions = {}
+    for rule_id, condition in records:
+        try:
+            conditions[rule_id] = compile_condition(condition)
+        except ValueError as e:
+            print(f"Skipping rule {rule_id}: {e}")
+    return conditions
+
+
+def rule_scores(
+    situation: Dict[str, Any], conditions: Dict[str, CompiledCondition]
+) -> Dict[str, float]:
+    """Applicability score of each rule whose condition the situation satisfies."""
+    scores = {}
+    for rule_id, condition in conditions.items():
+        score = condition.match(situation)
+        if score is not None:
+            scores[rule_id] = score
+    return scores
@@ -1,20 +1,47 @@
-from typing import Dict, List, Optional, Tuple, Type
+import asyncio
+from contextlib import contextmanager
+from threading import Lock
+from time import time
+from typing import Any, Dict, List, Optional, Tuple, Type
 
-import dspy
 from orjson import loads
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, create_model
 
-from . import linkMlDb
+from . import (
+    MAX_TOKENS,
+    SIEVE_CONCURRENCY,
+    SIEVE_PACKED,
+    SIEVE_SHORTLIST,
+    SIEVE_THRESHOLD,
+    SIEVE_TIMEOUT,
+    TEMPLATE_CACHE_SIZE,
+    VERSION_CHECK_INTERVAL,
+    chat_model,
+    configure_dspy,
+    linkMlDb,
+)
+from .cache import LRUCache, ResultCache, result_cache
 from .models import ReportTemplate, SituationSchema, Template
-from .utils import json_schema_to_base_model
+from .prefilter import shortlist_templates
+from .storage import bump_template_version, get_template_versions
+from .utils import count_tokens, json_schema_to_base_model
 
 models_by_name: Dict[str, Type[Template]] = dict(
     SituationSchema=SituationSchema, ReportTemplate=ReportTemplate
 )
 
-_template_cache: Dict[Tuple[str, str], Type[Template]] = {}
-_schema_cache: Dict[Tuple[str, str], BaseModel] = {}
-_module_cache: Dict[Tuple[str, str], BaseModel] = {}
+# All keyed by (schema_id, schema_type)
+_template_cache = LRUCache(TEMPLATE_CACHE_SIZE)
+_schema_cache = LRUCache(TEMPLATE_CACHE_SIZE)
+_module_cache = LRUCache(TEMPLATE_CACHE_SIZE)
+# Keyed by (schema_ids, schema_type, schemas), so a changed template gets a new module
+_packed_module_cache = LRUCache(TEMPLATE_CACHE_SIZE)
+
+# Last version stamp seen for each template, and when we last looked
+_template_versions: Dict[Tuple[str, str], int] = {}
+_versions_updated = 0
+_versions_checked = 0.0
+_versions_lock = Lock()
 
 
 class BaseModelWithConfidence(BaseModel):
@@ -23,22 +50,67 @@ class BaseModelWithConfidence(BaseModel):
     )
 
 
+def _drop_compiled(schema_id: str, schema_type: str):
+    for cache in (_template_cache, _schema_cache, _module_cache):
+        cache.pop((schema_id, schema_type))
+
+
+def check_template_versions():
+    """Drop compiled templates that another worker has invalidated since the last check."""
+    global _versions_updated, _versions_checked
+    if time() - _versions_checked < VERSION_CHECK_INTERVAL:
+        return
+    if not _versions_lock.acquire(blocking=False):
+        return
+    try:
+        _versions_checked = time()
+        for schema_id, schema_type, version, updated in get_template_versions(
+            _versions_updated
+        ):
+            if _template_versions.get((schema_id, schema_type)) != version:
+                _template_versions[(schema_id, schema_type)] = version
+                _drop_compiled(schema_id, schema_type)
+            _versions_updated = max(_versions_updated, updated)
+    finally:
+        _versions_lock.release()
+
+
+def invalidate_template(schema_id: str, schema_type: str):
+    """Forget a template that was changed or deleted, in this worker and the others."""
+    _drop_compiled(schema_id, schema_type)
+    bump_template_version(schema_id, schema_type)
+
+
 def get_template(schema_id: str, schema_type: str) -> BaseModel:
-    global _template_cache
+    check_template_versions()
     tmpl = _template_cache.get((schema_id, schema_type))
     if not tmpl:
         assert schema_type in (models_by_name), f"Unexpected schema type: {schema_type}"
         res = linkMlDb.find(dict(category=schema_type, id=schema_id))
         assert res.num_rows, f"Could not find {schema_id}"
-        row = res.rows[0]
-        assert row.pop("category") == schema_type
-        tmpl = models_by_name[schema_type](**row)
-        _template_cache[(schema_id, schema_type)] = tmpl
+        tmpl = _cache_template(res.rows[0], schema_type)
+    return tmpl
+
+
+def _cache_template(row: Dict, schema_type: str) -> BaseModel:
+    row = dict(row)
+    assert row.pop("category") == schema_type
+    tmpl = models_by_name[schema_type](**row)
+    _template_cache[(tmpl.id, schema_type)] = tmpl
     return tmpl
 
 
+def find_current(schema_type: str):
+    """The current templates of a type. Types without a status have only current ones."""
+    assert schema_type in models_by_name, f"Unexpected schema type: {schema_type}"
+    query = dict(category=schema_type)
+    if "status" in models_by_name[schema_type].model_fields:
+        query["status"] = "current"
+    return linkMlDb.find(query)
+
+
 def get_schema(schema_id: str, schema_type: str) -> BaseModelWithConfidence:
-    global _schema_cache
+    check_template_versions()
     schema = _schema_cache.get((schema_id, schema_type))
     if not schema:
         tmpl = get_template(schema_id, schema_type)
@@ -57,9 +129,12 @@ def get_schema(schema_id: str, schema_type: str) -> BaseModelWithConfidence:
 
 
 def get_dspy_module(schema_id: str, schema_type: str):
-    global _module_cache
+    check_template_versions()
     module = _module_cache.get((schema_id, schema_type))
     if not module:
+        import dspy
+
+        configure_dspy()
         output_schema = get_schema(schema_id, schema_type)
 
         class Signature(dspy.Signature):
@@ -73,27 +148,380 @@ def get_dspy_module(schema_id: str, schema_type: str):
     return module
 
 
+# How far the warm-up started at boot has got, and why it stopped if it failed
+warm_up_progress = dict(total=0, compiled=0, failed=0, done=False, error=None)
+
+
+def warm_up(schema_types: List[str] = list(models_by_name)):
+    """Compile the modules of all current templates, so that first evaluations after
+    a restart are as fast as later ones. Runs in a worker thread at startup."""
+    warm_up_progress.update(total=0, compiled=0, failed=0, done=False, error=None)
+    start = time()
+    try:
+        rows = []
+        for schema_type in schema_types:
+            res = find_current(schema_type)
+            rows += [(row, schema_type) for row in res.rows]
+        # Compiling more than the caches hold would only evict the first ones
+        rows = rows[:TEMPLATE_CACHE_SIZE]
+        warm_up_progress["total"] = len(rows)
+        for row, schema_type in rows:
+            try:
+                tmpl = _cache_template(row, schema_type)
+                get_dspy_module(tmpl.id, schema_type)
+                warm_up_progress["compiled"] += 1
+            except Exception as e:
+                print(f"Could not compile {schema_type} {row.get('id')}: {e}")
+                warm_up_progress["failed"] += 1
+        print(
+            f"Compiled {warm_up_progress['compiled']} templates in {time() - start:.1f}s"
+        )
+    except Exception as e:
+        # Nobody awaits the warm-up, this is the only trace of the failure
+        print(f"Template warm-up failed: {e!r}")
+        warm_up_progress["error"] = repr(e)
+    finally:
+        warm_up_progress["done"] = True
+
+
 async def evaluate_one(
-    text: str, schema_id: str, schema_type: str = "ProgramTemplate"
+    text: str,
+    schema_id: str,
+    schema_type: str = "ProgramTemplate",
+    use_cache: bool = True,
 ) -> Optional[BaseModelWithConfidence]:
-    """Evaluate a single text against a schema."""
-    module = get_dspy_module(schema_id, schema_type)
+    """Evaluate a single text against a schema.
+
+    Results are reused from the result cache unless `use_cache` is False."""
+    # Resolving the template may hit the database, keep it off the event loop
+    module, schema, tmpl = await asyncio.to_thread(
+        lambda: (
+            get_dspy_module(schema_id, schema_type),
+            get_schema(schema_id, schema_type),
+            get_template(schema_id, schema_type),
+        )
+    )
+    key = ResultCache.make_key(
+        text, tmpl.schema_def, module.signature.instructions, chat_model
+    )
+    if use_cache:
+        cached = await asyncio.to_thread(result_cache.get, key)
+        if cached is not None:
+            return schema.model_validate_json(cached)
     # TODO: Add metrics
-    result = module(input=text)
+    result = await module.acall(input=text)
     if result:
+        await asyncio.to_thread(
+            result_cache.set, key, schema_id, result.output.model_dump_json()
+        )
         return result.output
 
 
+PACKED_INSTRUCTIONS = """Answer the question based on the context and query provided, once for each field of the output, following the schema of that field, and on the scale of 0-1 tell how confident you are about each answer."""
+
+
+def get_packed_module(schema_ids: List[str], schema_type: str):
+    """A module answering for several templates at once, in one output field per template."""
+    schemas = tuple(get_schema(schema_id, schema_type) for schema_id in schema_ids)
+    key = (tuple(schema_ids), schema_type, schemas)
+    module = _packed_module_cache.get(key)
+    if not module:
+        import dspy
+
+        configure_dspy()
+        output_schema = create_model(
+            f"{schema_type}Pack",
+            **{
+                f"answer_{i}": (
+                    Optional[schema],
+                    Field(None, description=f"Answer for {schema_type} {schema_id}"),
+                )
+                for i, (schema_id, schema) in enumerate(zip(schema_ids, schemas))
+            },
+        )
+        signature = dspy.make_signature(
+            dict(
+                input=(str, dspy.InputField()),
+                output=(output_schema, dspy.OutputField()),
+            ),
+            PACKED_INSTRUCTIONS,
+        )
+        module = dspy.Predict(signature)
+        _packed_module_cache[key] = module
+    return module
+
+
+def pack_templates(
+    text: str, schema_ids: List[str], schema_type: str
+) -> List[List[str]]:
+    """Group templates so that the text and the schemas of each group fit in MAX_TOKENS."""
+    budget = MAX_TOKENS - count_tokens(text)
+    packs: List[List[str]] = []
+    used = 0
+    for schema_id in schema_ids:
+        tokens = count_tokens(get_template(schema_id, schema_type).schema_def)
+        if not packs or used + tokens > budget:
+            # A template too large for the budget still gets a pack of its own
+            packs.append([])
+            used = 0
+        packs[-1].append(schema_id)
+        used += tokens
+    return packs
+
+
+async def evaluate_packed(
+    text: str,
+    schema_ids: List[str],
+    schema_type: str = "ProgramTemplate",
+    concurrency: int = SIEVE_CONCURRENCY,
+    timeout: Optional[float] = SIEVE_TIMEOUT,
+    use_cache: bool = True,
+) -> List[Optional[BaseModelWithConfidence]]:
+    """Evaluate a text against several templates with as few LLM calls as fit in MAX_TOKENS,
+    instead of sending the text once per template. Outputs are in the order of `schema_ids`.
+
+    Results are cached per template, so they are reused whatever the grouping."""
+    templates, schemas = await asyncio.to_thread(
+        lambda: (
+            {sid: get_template(sid, schema_type) for sid in schema_ids},
+            {sid: get_schema(sid, schema_type) for sid in schema_ids},
+        )
+    )
+    keys = {
+        sid: ResultCache.make_key(
+            text, tmpl.schema_def, PACKED_INSTRUCTIONS, chat_model
+        )
+        for sid, tmpl in templates.items()
+    }
+    outputs: Dict[str, Optional[BaseModelWithConfidence]] = {}
+    if use_cache:
+        cached = await asyncio.to_thread(
+            lambda: {sid: result_cache.get(keys[sid]) for sid in schema_ids}
+        )
+        for sid in schema_ids:
+            if cached[sid] is not None:
+                outputs[sid] = schemas[sid].model_validate_json(cached[sid])
+    missing = [sid for sid in schema_ids if sid not in outputs]
+    packs = await asyncio.to_thread(pack_templates, text, missing, schema_type)
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def evaluate_pack(pack: List[str]):
+        async with semaphore:
+            try:
+                module = await asyncio.to_thread(get_packed_module, pack, schema_type)
+                result = await asyncio.wait_for(module.acall(input=text), timeout)
+            except TimeoutError:
+                print(f"Timed out evaluating {schema_type} {', '.join(pack)}")
+                return
+            except (AssertionError, TypeError):
+                raise
+            except Exception as e:
+                print(f"Could not evaluate {schema_type} {', '.join(pack)}: {e}")
+                return
+        answered = {}
+        for i, sid in enumerate(pack):
+            output = getattr(result.output, f"answer_{i}")
+            if output:
+                answered[sid] = output
+        await asyncio.to_thread(
+            lambda: [
+                result_cache.set(keys[sid], sid, output.model_dump_json())
+                for sid, output in answered.items()
+            ]
+        )
+        outputs.update(answered)
+
+    await asyncio.gather(*[evaluate_pack(pack) for pack in packs])
+    return [outputs.get(sid) for sid in schema_ids]
+
+
+async def score_templates(
+    text: str,
+    schema_ids: List[str],
+    schema_type: str = "ProgramTemplate",
+    concurrency: int = SIEVE_CONCURRENCY,
+    timeout: Optional[float] = SIEVE_TIMEOUT,
+    use_cache: bool = True,
+    packed: bool = SIEVE_PACKED,
+) -> List[Tuple[str, BaseModel, float]]:
+    """Evaluate a text against the given templates, at most `concurrency` at a time.
+
+    If `packed` is set, several templates are scored per LLM call, see `evaluate_packed`.
+    Templates that fail, or do not answer within `timeout` seconds, are left out of the
+    results, but assertion and type errors, which are bugs, propagate.
+    Results are sorted by decreasing confidence, then template id."""
+    if packed:
+        outputs = await evaluate_packed(
+            text, schema_ids, schema_type, concurrency, timeout, use_cache
+        )
+    else:
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def bounded_evaluate(
+            schema_id: str,
+        ) -> Optional[BaseModelWithConfidence]:
+            async with semaphore:
+                try:
+                    return await asyncio.wait_for(
+                        evaluate_one(text, schema_id, schema_type, use_cache), timeout
+                    )
+                except TimeoutError:
+                    print(f"Timed out evaluating {schema_type} {schema_id}")
+                except (AssertionError, TypeError):
+                    raise
+                except Exception as e:
+                    print(f"Could not evaluate {schema_type} {schema_id}: {e}")
+
+        outputs = await asyncio.gather(*[bounded_evaluate(sid) for sid in schema_ids])
+    result = [(sid, m, m.confidence) for sid, m in zip(schema_ids, outputs) if m]
+    result.sort(key=lambda x: (x[2], x[0]), reverse=True)
+    return result
+
+
 async def evaluate_many(
-    text: str, schema_type: str = "ProgramTemplate", include_draft=False
+    text: str,
+    schema_type: str = "ProgramTemplate",
+    include_draft=False,
+    concurrency: int = SIEVE_CONCURRENCY,
+    timeout: Optional[float] = SIEVE_TIMEOUT,
+    use_cache: bool = True,
+    shortlist: int = SIEVE_SHORTLIST,
+    packed: bool = SIEVE_PACKED,
 ) -> List[Tuple[str, BaseModel, float]]:
+    """Evaluate a text against all current templates, see `score_templates`.
+
+    If `shortlist` is set, only that many templates nearest to the text by embedding
+    are sent to the LLM."""
     # TODO: Only those connected to an org
-    res = linkMlDb.find(dict(category=schema_type, status="current"))
+    res = await asyncio.to_thread(find_current, schema_type)
     # TODO: Union drafts if required
-    result = []
-    for row in res.rows:
-        m = await evaluate_one(text, row["id"], schema_type)
-        if m:
-            result.append[(m, row["id"], m.confidence)]
-    result.sort(key=lambda x: (x[2], x[1]), reverse=True)
-    return result
+    if shortlist and res.num_rows > shortlist:
+        schema_ids = await shortlist_templates(text, res.rows, schema_type, shortlist)
+    else:
+        schema_ids = [row["id"] for row in res.rows]
+    return await score_templates(
+        text, schema_ids, schema_type, concurrency, timeout, use_cache, packed
+    )
+
+
+async def evaluate_top_k(
+    text: str,
+    schema_type: str = "ProgramTemplate",
+    k: int = 1,
+    threshold: float = SIEVE_THRESHOLD,
+    wave_size: int = SIEVE_CONCURRENCY,
+    timeout: Optional[float] = SIEVE_TIMEOUT,
+    use_cache: bool = True,
+    packed: bool = SIEVE_PACKED,
+) -> Tuple[List[Tuple[str, BaseModel, float]], Dict[str, Any]]:
+    """Evaluate the current templates in waves of `wave_size`, those nearest to the text
+    by embedding first, until `k` of them reach a confidence of `threshold`.
+
+    Returns the results, sorted as by `score_templates`, and an explanation of which
+    templates were skipped and why."""
+    res = await asyncio.to_thread(find_current, schema_type)
+    ranked = await shortlist_templates(text, res.rows, schema_type, res.num_rows)
+    # Anything the index did not return still gets its chance, last
+    seen = set(ranked)
+    ranked += [row["id"] for row in res.rows if row["id"] not in seen]
+    results: List[Tuple[str, BaseModel, float]] = []
+    evaluated = 0
+    while evaluated < len(ranked):
+        wave = ranked[evaluated : evaluated + wave_size]
+        results += await score_templates(
+            text, wave, schema_type, wave_size, timeout, use_cache, packed
+        )
+        evaluated += len(wave)
+        if sum(1 for _, _, confidence in results if confidence >= threshold) >= k:
+            break
+    results.sort(key=lambda x: (x[2], x[0]), reverse=True)
+    skipped = ranked[evaluated:]
+    if skipped:
+        reason = f"{k} templates reached a confidence of {threshold} after {evaluated} of {len(ranked)}, the rest are less similar to the text"
+    else:
+        reason = "No template was skipped"
+    return results, dict(evaluated=evaluated, skipped=skipped, reason=reason)
+
+
+async def shortlist_recall(
+    text: str, schema_type: str = "ProgramTemplate", ks: List[int] = [1, 5, 10, 20]
+) -> Dict[int, float]:
+    """For each shortlist size k, whether the best template found by scoring all of them
+    would have made the embedding shortlist. Scores every template, so use sparingly."""
+    results = await evaluate_many(text, schema_type, shortlist=0)
+    if not results:
+        return {}
+    best_id = results[0][0]
+    res = await asyncio.to_thread(find_current, schema_type)
+    ranked = await shortlist_templates(text, res.rows, schema_type, max(ks))
+    return {k: float(best_id in ranked[:k]) for k in ks}
+
+
+@contextmanager
+def uncached_lm():
+    """Use a copy of the DSPy LM without its own cache, so that measurements made with
+    use_cache=False time real LLM calls. Yields that LM, whose history holds those calls.
+    """
+    import dspy
+
+    configure_dspy()
+    lm = dspy.settings.lm.copy(cache=False)
+    with dspy.context(lm=lm):
+        yield lm
+
+
+async def benchmark_library_sizes(
+    text: str,
+    schema_type: str = "SituationSchema",
+    sizes: List[int] = [1, 10, 50, 100],
+    concurrency: int = SIEVE_CONCURRENCY,
+) -> Dict[int, Dict[str, float]]:
+    """Wall-clock time to score a text against libraries of the given sizes, taken from
+    the current templates, one template per call. Bypasses the result caches and the
+    shortlist: use sparingly.
+    """
+    res = await asyncio.to_thread(find_current, schema_type)
+    schema_ids = [row["id"] for row in res.rows]
+    report = {}
+    with uncached_lm():
+        for size in sorted(set(sizes)):
+            if size > len(schema_ids):
+                break
+            start = time()
+            results = await score_templates(
+                text,
+                schema_ids[:size],
+                schema_type,
+                concurrency,
+                use_cache=False,
+                packed=False,
+            )
+            seconds = time() - start
+            report[size] = dict(
+                seconds=seconds, per_template=seconds / size, answered=len(results)
+            )
+    return report
+
+
+async def compare_modes(
+    text: str, schema_type: str = "SituationSchema"
+) -> Dict[str, Dict[str, float]]:
+    """Time and tokens used to score all current templates one per call, and packed.
+    Bypasses the result caches, so every template is scored twice: use sparingly."""
+    report = {}
+    with uncached_lm() as lm:
+        for packed in (False, True):
+            seen = len(lm.history)
+            start = time()
+            results = await evaluate_many(
+                text, schema_type, use_cache=False, shortlist=0, packed=packed
+            )
+            usage = [entry.get("usage") or {} for entry in lm.history[seen:]]
+            report["packed" if packed else "single"] = dict(
+                seconds=time() - start,
+                calls=len(usage),
+                prompt_tokens=sum(u.get("prompt_tokens", 0) for u in usage),
+                completion_tokens=sum(u.get("completion_tokens", 0) for u in usage),
+                answered=len(results),
+            )
+    return report
@@ -52,8 +52,13 @@ High level programs that will start on set conditions and stops/shifts on others
 """
 
 # state.py
+import asyncio
+from itertools import count
+from typing import Any, Callable, Dict, Tuple
+
+from nicegui import run, ui
+
 from .drive import GoogleDriveHandler
-from nicegui import ui
 
 
 class AppState:
@@ -74,34 +79,87 @@ class AppState:
         ]
         self.current_stage_index = -1
         self.buttons = []
-
-    def set_folder_url(self, folder_url: str):
+        # Drive operations in progress, by client id then task id: (description, task)
+        self.tasks: Dict[str, Dict[int, Tuple[str, asyncio.Task]]] = {}
+        self._task_ids = count(1)
+
+    async def _run_drive(self, description: str, func: Callable, *args) -> Any:
+        """Run a blocking Drive call in a worker thread, so the event loop keeps serving
+        the other clients, and track it in `self.tasks` until it is done."""
+        client_id = ui.context.client.id
+        task_id = next(self._task_ids)
+        task = asyncio.ensure_future(run.io_bound(func, *args))
+        tasks = self.tasks.setdefault(client_id, {})
+        tasks[task_id] = (description, task)
+        ui.notify(f"{description}...", type="ongoing")
+        try:
+            return await task
+        finally:
+            tasks.pop(task_id, None)
+            if not tasks:
+                self.tasks.pop(client_id, None)
+
+    def cancel_tasks(self):
+        """Stop waiting for the Drive operations in progress started by the calling client.
+
+        A call already sent to Google still completes: its result is just dropped."""
+        tasks = self.tasks.get(ui.context.client.id, {})
+        for _, task in list(tasks.values()):
+            task.cancel()
+        ui.notify(f"Cancelled {len(tasks)} Drive operations", type="warning")
+
+    async def set_folder_url(self, folder_url: str):
         """Set the Google Drive folder URL and extract the folder ID."""
         self.folder_url = folder_url
         try:
-            self.drive_handler.set_folder_from_url(folder_url)
+            await self._run_drive(
+                "Checking the folder",
+                self.drive_handler.set_folder_from_url,
+                folder_url,
+            )
             ui.notify("Folder URL set successfully!", type="positive")
+            await self._run_drive(
+                "Listing the folder", self.drive_handler.check_folder_access
+            )
+        except asyncio.CancelledError:
+            ui.notify("Folder check cancelled", type="warning")
         except ValueError as e:
             ui.notify(str(e), type="negative")
 
-    def create_document(self, title: str, text: str, share_email: str = None):
+    async def create_document(self, title: str, text: str, share_email: str = None):
         """Create a document in the specified folder."""
         if not self.folder_url:
             ui.notify("Please set a Google Drive folder URL first!", type="negative")
             return
         try:
-            doc_url = self.drive_handler.create_document(title, text, share_email)
+            doc_url = await self._run_drive(
+                f"Creating document {title}",
+                self.drive_handler.create_document,
+                title,
+                text,
+                share_email,
+            )
             ui.notify(f"Document created successfully! URL: {doc_url}", type="positive")
+        except asyncio.CancelledError:
+            ui.notify(f"Creation of document {title} cancelled", type="warning")
         except Exception as e:
             ui.notify(f"Error creating document: {str(e)}", type="negative")
 
-    def create_spreadsheet(self, title: str, data: list, share_email: str = None):
+    async def create_spreadsheet(self, title: str, data: list, share_email: str = None):
         """Create a Google Sheet in the specified folder."""
         try:
-            sheet_url = self.drive_handler.create_spreadsheet(title, data, share_email)
+            sheet_url = await self._run_drive(
+                f"Creating spreadsheet {title}",
+                self.drive_handler.create_spreadsheet,
+                title,
+                data,
+                share_email,
+            )
             ui.notify(
                 f"Spreadsheet created successfully! URL: {sheet_url}", type="positive"
             )
+        except asyncio.CancelledError:
+            ui.notify(f"Creation of spreadsheet {title} cancelled", type="warning")
         except Exception as e:
             ui.notify(f"Error creating spreadsheet: {str(e)}", type="negative")
 
@@ -1,13 +1,303 @@
-from . import neoDriver
-from .utils import list_models
+from typing import Any, Dict, Iterator, List, Optional, Tuple
 
+from neo4j import Query
+from neo4j.time import Date, DateTime, Time
 
-def create_id_constraints():
+from . import NEO4J_QUERY_TIMEOUT, asyncNeoDriver, nconf, neoDriver
+from .cache import entity_cache
+from .utils import is_multivalued, list_models, models_by_category
+
+# A reference slot to follow, mapped to the category it points to and the references to follow from there
+References = Dict[str, Tuple[str, "References"]]
+
+
+# Bump when the statements below change, so deployments apply them again
+SCHEMA_VERSION = 3
+
+# Properties our queries filter or merge on, besides ids. The category is the node
+# label, which Neo4j already indexes. Several properties make a composite index.
+INDEXED_PROPERTIES = [
+    ("Narrative", ("status",)),
+    ("Narrative", ("when",)),
+    ("SituationCondition", ("situation_schema",)),
+    ("TemplateVersion", ("updated",)),
+    ("TemplateVersion", ("template_id", "category")),
+    ("DriveSync", ("folder_id",)),
+]
+
+# Indexes created by earlier schema versions, on properties no node carries
+OBSOLETE_INDEXES = [
+    "index_programtemplate_status",
+    "index_situationschema_status",
+    "index_reporttemplate_status",
+]
+
+
+def schema_statements() -> Dict[str, str]:
+    """The constraints and indexes the application needs, by name."""
+    statements = {}
     for model in list_models():
-        neoDriver.execute_query(
-            f"CREATE CONSTRAINT unique_{model.__name__.lower()}_id IF NOT EXISTS FOR (n:{model.__name__}) REQUIRE n.id IS UNIQUE;"
+        label = model.__name__
+        name = f"unique_{label.lower()}_id"
+        statements[name] = (
+            f"CREATE CONSTRAINT {name} IF NOT EXISTS FOR (n:{label}) REQUIRE n.id IS UNIQUE"
         )
+    for label, props in INDEXED_PROPERTIES:
+        name = f"index_{label.lower()}_{'_'.join(props)}"
+        properties = ", ".join(f"n.{prop}" for prop in props)
+        statements[name] = (
+            f"CREATE INDEX {name} IF NOT EXISTS FOR (n:{label}) ON ({properties})"
+        )
+    return statements
+
+
+def ensure_schema():
+    """Create the changes constraints and indexes and drop obsolete ones in one
+    transaction, and record the schema version, unless this version was already applied.
+    """
+    records, _, _ = neoDriver.execute_query(
+        "MATCH (v:SchemaVersion) RETURN max(v.version) AS version"
+    )
+    if (records[0]["version"] or 0) >= SCHEMA_VERSION:
+        return
+    with neoDriver.session() as session:
+        existing = {r["name"] for r in session.run("SHOW CONSTRAINTS YIELD name")}
+        existing |= {r["name"] for r in session.run("SHOW INDEXES YIELD name")}
+        changes = [
+            statement
+            for name, statement in schema_statements().items()
+            if name not in existing
+        ]
+        changes += [
+            f"DROP INDEX {name} IF EXISTS"
+            for name in OBSOLETE_INDEXES
+            if name in existing
+        ]
+        if changes:
+
+            def apply(tx):
+                for statement in changes:
+                    tx.run(statement)
+
+            session.execute_write(apply)
+    neoDriver.execute_query(
+        "MERGE (v:SchemaVersion) SET v.version = $version", version=SCHEMA_VERSION
+    )
 
 
 def clear_database():
     neoDriver.execute_query("MATCH (n) DETACH DELETE n")
+
+
+def bump_template_version(template_id: str, category: str):
+    """Record that a template changed, so other workers drop what they compiled from it."""
+    neoDriver.execute_query(
+        """MERGE (v:TemplateVersion {template_id: $template_id, category: $category})
+        SET v.version = coalesce(v.version, 0) + 1, v.updated = timestamp()""",
+        template_id=template_id,
+        category=category,
+    )
+
+
+def get_template_versions(since: int = 0) -> List[Tuple[str, str, int, int]]:
+    """Return (template_id, category, version, updated) for templates changed after `since` (ms)."""
+    records, _, _ = neoDriver.execute_query(
+        """MATCH (v:TemplateVersion) WHERE v.updated > $since
+        RETURN v.template_id, v.category, v.version, v.updated""",
+        since=since,
+    )
+    return [tuple(r.values()) for r in records]
+
+
+def get_drive_page_token(folder_id: str) -> Optional[str]:
+    """The Drive changes token saved by the last sync of a folder, if any."""
+    records, _, _ = neoDriver.execute_query(
+        "MATCH (s:DriveSync {folder_id: $folder_id}) RETURN s.page_token AS token",
+        folder_id=folder_id,
+    )
+    return records[0]["token"] if records else None
+
+
+def set_drive_page_token(folder_id: str, page_token: str):
+    neoDriver.execute_query(
+        """MERGE (s:DriveSync {folder_id: $folder_id})
+        SET s.page_token = $page_token, s.updated = timestamp()""",
+        folder_id=folder_id,
+        page_token=page_token,
+    )
+
+
+def _native(value: Any) -> Any:
+    """Convert the neo4j temporal types in a query result to their Python equivalents."""
+    if isinstance(value, (Date, DateTime, Time)):
+        return value.to_native()
+    if isinstance(value, dict):
+        return {k: _native(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_native(v) for v in value]
+    return value
+
+
+async def _run(query: str, **params) -> List[Dict[str, Any]]:
+    """Run a query on the async driver, for request handlers that must not block the loop.
+
+    Records are returned as dicts of plain Python values."""
+    async with asyncNeoDriver.session(
+        database=nconf.get("database", "neo4j")
+    ) as session:
+        result = await session.run(Query(query, timeout=NEO4J_QUERY_TIMEOUT), **params)
+        return [_native(record.data()) async for record in result]
+
+
+async def get_object(category: str, id: str) -> Optional[Dict[str, Any]]:
+    """Read an object, from the entity cache when it was read recently."""
+    obj = entity_cache.get(category, id)
+    if obj is not None:
+        return obj
+    records = await _run(
+        f"MATCH (n:{category} {{id: $id}}) RETURN n {{.*}} AS obj", id=id
+    )
+    if records:
+        obj = records[0]["obj"]
+        entity_cache.set(category, id, obj)
+        return dict(obj)
+
+
+def _properties(row: Dict[str, Any]) -> Dict[str, Any]:
+    # The category is the node label, and Neo4j does not store nulls
+    return {k: v for k, v in row.items() if k != "category" and v is not None}
+
+
+async def insert_object(row: Dict[str, Any]):
+    await _run(f"CREATE (n:{row['category']}) SET n = $props", props=_properties(row))
+
+
+async def update_object(category: str, id: str, row: Dict[str, Any]):
+    """Replace the properties of an object, keeping its id."""
+    await _run(
+        f"MATCH (n:{category} {{id: $id}}) SET n = $props",
+        id=id,
+        props={**_properties(row), "id": id},
+    )
+    entity_cache.invalidate(category, id)
+
+
+async def delete_object(category: str, id: str) -> bool:
+    """Delete an object and its relationships. Returns whether it existed."""
+    records = await _run(
+        f"MATCH (n:{category} {{id: $id}}) DETACH DELETE n RETURN count(*) AS deleted",
+        id=id,
+    )
+    entity_cache.invalidate(category, id)
+    return records[0]["deleted"] > 0
+
+
+def _projection(var: str, category: str, references: References, depth: int = 0) -> str:
+    models = models_by_category()
+    fields = models[category].model.model_fields
+    slots = []
+    for slot, (ref_category, nested) in references.items():
+        assert slot in fields, f"{category} has no {slot}"
+        assert ref_category in models, f"Unknown category {ref_category}"
+        multivalued = is_multivalued(fields[slot].annotation)
+        ids = f"{var}.{slot}" if multivalued else f"[{var}.{slot}]"
+        ref, ref_var = f"ref{depth}", f"n{depth + 1}"
+        subquery = f"""COLLECT {{
+            UNWIND coalesce({ids}, []) AS {ref}
+            MATCH ({ref_var}:{ref_category} {{id: {ref}}})
+            RETURN {_projection(ref_var, ref_category, nested, depth + 1)} }}"""
+        slots.append(f"{slot}: {subquery if multivalued else f'head({subquery})'}")
+    if not slots:
+        return f"{var} {{.*}}"
+    return f"{var} {{.*, _references: {{{', '.join(slots)}}}}}"
+
+
+async def load_with_references(
+    category: str, id: str, references: References
+) -> Optional[Dict[str, Any]]:
+    """Load an object and the objects it refers to, recursively, in a single query.
+
+    The referenced objects are put in a `_references` dict, by slot: a list for
+    multivalued slots, an object or None otherwise. The original ids are kept. E.g.
+    `load_with_references("Organization", id, dict(casebook=("Case", dict(narratives=("Narrative", {})))))`
+    """
+    records = await _run(
+        f"MATCH (n0:{category} {{id: $id}}) RETURN {_projection('n0', category, references)} AS obj",
+        id=id,
+    )
+    if records:
+        return records[0]["obj"]
+
+
+FILTER_OPERATORS = dict(eq="=", gt=">", gte=">=", lt="<", lte="<=")
+
+
+def has_ids(category: str) -> bool:
+    return "id" in models_by_category()[category].model.model_fields
+
+
+def _cursor(category: str) -> str:
+    # Categories without ids are paged by element id, stable while the node exists
+    return "n.id" if has_ids(category) else "elementId(n)"
+
+
+async def find_page(
+    category: str,
+    filters: List[Tuple[str, str, Any]] = [],
+    fields: Optional[List[str]] = None,
+    after: Optional[str] = None,
+    limit: int = 100,
+) -> Tuple[List[Dict[str, Any]], int, Optional[str]]:
+    """A page of objects of a category, the total count of matching objects, and the
+    cursor of the next page if this one is full.
+
+    Objects are ordered by id, or by element id for categories without ids.
+    `filters` are (property, operator, value) triples, with operators from FILTER_OPERATORS.
+    `fields` restricts the returned properties, the id is always included if any.
+    `after` is the cursor returned with the previous page."""
+    conditions = [
+        f"n.{prop} {FILTER_OPERATORS[op]} $p{i}"
+        for i, (prop, op, _) in enumerate(filters)
+    ]
+    params = {f"p{i}": value for i, (_, _, value) in enumerate(filters)}
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+    records = await _run(
+        f"MATCH (n:{category}) {where} RETURN count(n) AS total", **params
+    )
+    total = records[0]["total"]
+    cursor = _cursor(category)
+    if after is not None:
+        conditions.append(f"{cursor} > $after")
+        where = f"WHERE {' AND '.join(conditions)}"
+    if fields:
+        fields = ["id", *fields] if has_ids(category) else fields
+        projection = ", ".join(f".{field}" for field in dict.fromkeys(fields))
+    else:
+        projection = ".*"
+    records = await _run(
+        f"""MATCH (n:{category}) {where}
+        RETURN n {{{projection}}} AS obj, {cursor} AS cursor ORDER BY cursor LIMIT $limit""",
+        after=after,
+        limit=limit,
+        **params,
+    )
+    next_cursor = records[-1]["cursor"] if len(records) == limit else None
+    return [r["obj"] for r in records], total, next_cursor
+
+
+def iter_objects(
+    category: str, after: Optional[str] = None
+) -> Iterator[Dict[str, Any]]:
+    """Stream all objects of a category from the database cursor, ordered by id, or by
+    element id for categories without ids. Only the former can be resumed `after` an id.
+    """
+    assert after is None or has_ids(category), f"{category} objects have no id"
+    cursor = _cursor(category)
+    where = f"WHERE {cursor} > $after" if after is not None else ""
+    with neoDriver.session() as session:
+        result = session.run(
+            f"MATCH (n:{category}) {where} RETURN n {{.*}} AS obj ORDER BY {cursor}",
+            after=after,
+        )
+        for record in result:
+            yield record["obj"]
@@ -1,11 +1,30 @@
+from collections import OrderedDict
 from copy import deepcopy
 from enum import Enum
+from functools import cache
+from hashlib import sha256
+from importlib import import_module
 from inspect import isclass
-from typing import Any, Dict, List, Optional, Tuple, Type, TypeVar, Union
+from threading import Lock
+from typing import (
+    Any,
+    Dict,
+    List,
+    Optional,
+    Tuple,
+    Type,
+    TypeVar,
+    Union,
+    get_args,
+    get_origin,
+)
 
-from pydantic import BaseModel, Field, create_model
+from orjson import OPT_SORT_KEYS, dumps, loads
+from pydantic import BaseModel, Field, TypeAdapter, create_model
 from pydantic.fields import FieldInfo
 
+from . import SCHEMA_REGISTRY_SIZE
+
 
 def make_field_optional(field: FieldInfo, default: Any = None) -> Tuple[Any, FieldInfo]:
     new = deepcopy(field)
@@ -17,6 +36,7 @@ def make_field_optional(field: FieldInfo, default: Any = None) -> Tuple[Any, Fie
 BaseModelT = TypeVar("BaseModelT", bound=BaseModel)
 
 
+@cache
 def to_optional(model: Type[BaseModelT]) -> Type[BaseModelT]:
     """Transform a schema into an equivalent optional schema"""
     # https://github.com/pydantic/pydantic/issues/3120#issuecomment-1528030416
@@ -31,6 +51,34 @@ def to_optional(model: Type[BaseModelT]) -> Type[BaseModelT]:
     )
 
 
+@cache
+def _token_encoding():
+    import tiktoken
+
+    return tiktoken.get_encoding("cl100k_base")
+
+
+def count_tokens(text: str) -> int:
+    """Approximate token count: the chat model's own tokenizer is not available locally."""
+    return len(_token_encoding().encode(text))
+
+
+def split_tokens(text: str, size: int) -> List[str]:
+    """Split a text in chunks of at most `size` tokens, counted as by `count_tokens`."""
+    tokens = _token_encoding().encode(text)
+    return [
+        _token_encoding().decode(tokens[i : i + size])
+        for i in range(0, len(tokens), size)
+    ]
+
+
+def is_multivalued(annotation: Any) -> bool:
+    """Whether a field annotation is a list, possibly optional."""
+    if get_origin(annotation) is Union:
+        return any(is_multivalued(arg) for arg in get_args(annotation))
+    return get_origin(annotation) is list
+
+
 def clean(m: Union[Dict, List[Dict]]) -> Union[Dict, List[Dict]]:
     if isinstance(m, list):
         for r in m:
@@ -40,9 +88,26 @@ def clean(m: Union[Dict, List[Dict]]) -> Union[Dict, List[Dict]]:
     return m
 
 
+class ModelInfo:
+    """What the API and storage need to know about a model, computed once by `model_info`."""
+
+    def __init__(self, model: Type[BaseModel]):
+        self.model = model
+        self.json_schema = model.model_json_schema()
+        self.category: str = self.json_schema["title"]
+        self.partial = to_optional(model)
+        self.adapter = TypeAdapter(model)
+
+
+@cache
+def model_info(model: Type[BaseModel]) -> ModelInfo:
+    return ModelInfo(model)
+
+
 def dump(m: BaseModel) -> dict:
-    d = m.model_dump()
-    d["category"] = m.model_json_schema()["title"]
+    info = model_info(type(m))
+    d = info.adapter.dump_python(m)
+    d["category"] = info.category
     return d
 
 
@@ -57,56 +122,158 @@ type_mapping: dict[str, type] = {
 }
 
 
-def json_schema_to_base_model(
-    schema: dict[str, Any], name: Optional[str] = None, base=BaseModel
-) -> Type[BaseModel]:
-    properties = schema.get("properties", {})
-    required_fields = schema.get("required", [])
-    model_fields = {}
-
-    def process_field(field_name: str, field_props: dict[str, Any]) -> tuple:
-        """Recursively processes a field and returns its type and Field instance."""
-        json_type = field_props.get("type", "string")
-        enum_values = field_props.get("enum")
-
-        # Handle Enums
-        if enum_values:
-            enum_name: str = f"{field_name.capitalize()}Enum"
-            field_type = Enum(enum_name, {v: v for v in enum_values})
-        # Handle Nested Objects
-        elif json_type == "object" and "properties" in field_props:
-            field_type = json_schema_to_base_model(
-                field_props
-            )  # Recursively create submodel
-        # Handle Arrays with Nested Objects
-        elif json_type == "array" and "items" in field_props:
-            item_props = field_props["items"]
-            if item_props.get("type") == "object":
-                item_type: type[BaseModel] = json_schema_to_base_model(item_props)
+class SchemaModels:
+    """Pydantic models generated from JSON schemas, shared between identical fragments.
+
+    Enums and submodels are keyed by a hash of their canonical JSON, so the ones
+    repeated across many templates resolve to the same class. At most `maxsize`
+    classes are kept, least recently used first out, and a named model replaces the
+    previous model of that name. `dumps` serializes the schemas compiled so far, and
+    `loads` rebuilds them, e.g. in another worker.
+    """
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._classes: OrderedDict[str, type] = OrderedDict()
+        self._compiled: Dict[str, Tuple[Any, Optional[str], str]] = {}
+        # Key of the current model of each name
+        self._named: Dict[str, str] = {}
+        self._lock = Lock()
+
+    @staticmethod
+    def key(*fragment: Any) -> str:
+        return sha256(dumps(fragment, option=OPT_SORT_KEYS)).hexdigest()
+
+    def _get(self, key: str) -> Optional[type]:
+        with self._lock:
+            cls = self._classes.get(key)
+            if cls is not None:
+                self._classes.move_to_end(key)
+            return cls
+
+    def _share(
+        self,
+        key: str,
+        cls: type,
+        compiled: Optional[Tuple[Any, Optional[str], str]] = None,
+    ) -> type:
+        with self._lock:
+            # Another thread may have built the same class meanwhile: keep the first
+            cls = self._classes.setdefault(key, cls)
+            self._classes.move_to_end(key)
+            if compiled:
+                name = compiled[1]
+                previous = self._named.get(name)
+                if previous is not None and previous != key:
+                    self._classes.pop(previous, None)
+                    self._forget(previous)
+                self._named[name] = key
+                self._compiled[key] = compiled
+            while len(self._classes) > self.maxsize:
+                evicted, _ = self._classes.popitem(last=False)
+                self._forget(evicted)
+            return cls
+
+    def _forget(self, key: str):
+        compiled = self._compiled.pop(key, None)
+        if compiled and self._named.get(compiled[1]) == key:
+            del self._named[compiled[1]]
+
+    def enum(self, name: str, values: List[Any]) -> Type[Enum]:
+        key = self.key("enum", name, values)
+        cls = self._get(key)
+        if cls is None:
+            cls = self._share(key, Enum(name, {v: v for v in values}))
+        return cls
+
+    def model(
+        self, schema: Dict[str, Any], name: Optional[str] = None, base=BaseModel
+    ) -> Type[BaseModel]:
+        base_path = f"{base.__module__}:{base.__qualname__}"
+        key = self.key("model", schema, name, base_path)
+        cls = self._get(key)
+        if cls is None:
+            # Nested models are rebuilt along with the schemas containing them
+            compiled = (schema, name, base_path) if name else None
+            cls = self._share(key, self._build(schema, name, base), compiled)
+        return cls
+
+    def _build(
+        self, schema: Dict[str, Any], name: Optional[str], base
+    ) -> Type[BaseModel]:
+        properties = schema.get("properties", {})
+        required_fields = schema.get("required", [])
+        model_fields = {}
+
+        def process_field(field_name: str, field_props: dict[str, Any]) -> tuple:
+            """Recursively processes a field and returns its type and Field instance."""
+            json_type = field_props.get("type", "string")
+            enum_values = field_props.get("enum")
+
+            # Handle Enums
+            if enum_values:
+                field_type = self.enum(f"{field_name.capitalize()}Enum", enum_values)
+            # Handle Nested Objects
+            elif json_type == "object" and "properties" in field_props:
+                field_type = self.model(field_props)  # Recursively create submodel
+            # Handle Arrays with Nested Objects
+            elif json_type == "array" and "items" in field_props:
+                item_props = field_props["items"]
+                if item_props.get("type") == "object":
+                    item_type: type[BaseModel] = self.model(item_props)
+                else:
+                    item_type: type = type_mapping.get(item_props.get("type"), Any)
+                field_type = list[item_type]
             else:
-                item_type: type = type_mapping.get(item_props.get("type"), Any)
-            field_type = list[item_type]
-        else:
-            field_type = type_mapping.get(json_type, Any)
+                field_type = type_mapping.get(json_type, Any)
+
+            # Handle default values and optionality
+            default_value = field_props.get("default", ...)
+            nullable = field_props.get("nullable", False)
+            description = field_props.get("title", "")
+
+            if nullable:
+                field_type = Optional[field_type]
 
-        # Handle default values and optionality
-        default_value = field_props.get("default", ...)
-        nullable = field_props.get("nullable", False)
-        description = field_props.get("title", "")
+            if field_name not in required_fields:
+                default_value = field_props.get("default", None)
 
-        if nullable:
-            field_type = Optional[field_type]
+            return field_type, Field(default_value, description=description)
 
-        if field_name not in required_fields:
-            default_value = field_props.get("default", None)
+        # Process each field
+        for field_name, field_props in properties.items():
+            model_fields[field_name] = process_field(field_name, field_props)
 
-        return field_type, Field(default_value, description=description)
+        return create_model(name or schema.get("title"), **model_fields, __base__=base)
+
+    def dumps(self) -> bytes:
+        with self._lock:
+            return dumps(list(self._compiled.values()))
+
+    def loads(self, data: bytes | str):
+        for schema, name, base_path in loads(data):
+            module, qualname = base_path.split(":")
+            base = import_module(module)
+            for attr in qualname.split("."):
+                base = getattr(base, attr)
+            self.model(schema, name, base)
+
+    def __len__(self) -> int:
+        return len(self._classes)
+
+
+schema_models = SchemaModels(SCHEMA_REGISTRY_SIZE)
+
+
+def json_schema_to_base_model(
+    schema: dict[str, Any], name: Optional[str] = None, base=BaseModel
+) -> Type[BaseModel]:
+    return schema_models.model(schema, name, base)
 
-    # Process each field
-    for field_name, field_props in properties.items():
-        model_fields[field_name] = process_field(field_name, field_props)
 
-    return create_model(name or schema.get("title"), **model_fields, __base__=base)
+@cache
+def models_by_category() -> Dict[str, ModelInfo]:
+    return {info.category: info for info in map(model_info, list_models())}
 
 
 def list_models():
@@ -0,0 +1,16 @@
+import os
+import shutil
+import tempfile
+from pathlib import Path
+
+
+def pytest_sessionstart(session):
+    # processieve reads config.ini from the working directory when it is imported:
+    # run the tests from a scratch directory, configured from the template.
+    workdir = tempfile.mkdtemp(prefix="processieve-tests-")
+    shutil.copy(
+        Path(__file__).parent.parent / "config.ini.template",
+        Path(workdir) / "config.ini",
+    )
+    session.config.add_cleanup(lambda: shutil.rmtree(workdir, ignore_errors=True))
+    os.chdir(workdir)
@@ -0,0 +1,213 @@
+"""A local stand-in for the Google Drive, Docs and Sheets APIs, enough for
+GoogleDriveHandler to create, fill and share files against it."""
+
+import json
+import re
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from itertools import count
+from typing import Any, Dict, List, Optional, Tuple
+
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+
+Response = Tuple[int, Dict[str, str], Any]
+
+REASONS = {200: "OK", 403: "Forbidden", 404: "Not Found", 409: "Conflict"}
+REASONS.update({429: "Too Many Requests", 500: "Internal Server Error"})
+REASONS.update({503: "Service Unavailable"})
+
+
+class FakeGoogle:
+    """Serves the calls in-process and keeps the files they create.
+
+    `fail` scripts the next matching call, made directly or within a batch, to get
+    an error instead. `calls` records (method, path, body) for each call as it is
+    handled, and `batches` the paths of the calls each batch request held."""
+
+    def __init__(self):
+        self.files: Dict[str, dict] = {}
+        self.calls: List[Tuple[str, str, Any]] = []
+        self.batches: List[List[str]] = []
+        self._failures: List[dict] = []
+        self._ids = count()
+        self._lock = threading.Lock()
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), _Handler)
+        self.server.fake = self
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}/"
+
+    def start(self):
+        threading.Thread(
+            target=self.server.serve_forever, args=(0.05,), daemon=True
+        ).start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def fail(
+        self,
+        method: str,
+        path: str,
+        status: int,
+        headers: Dict[str, str] = {},
+        applied: bool = False,
+        reason: Optional[str] = None,
+    ):
+        """Answer the next `method` call whose path matches the `path` pattern with
+        `status`. `applied` handles the call before failing, as when a response is
+        lost. `reason` is that of the error, e.g. "userRateLimitExceeded"."""
+        with self._lock:
+            self._failures.append(
+                dict(
+                    method=method,
+                    path=re.compile(path),
+                    status=status,
+                    headers=headers,
+                    applied=applied,
+                    reason=reason,
+                )
+            )
+
+    def service_account_info(self, private_key: str) -> dict:
+        """The content of a service account file whose tokens come from this server."""
+        return {
+            "type": "service_account",
+            "project_id": "fake",
+            "client_email": "sieve@fake.iam.gserviceaccount.com",
+            "client_id": "1",
+            "private_key_id": "1",
+            "private_key": private_key,
+            "token_uri": f"{self.url}token",
+        }
+
+    def paths(self, method: str = None) -> List[str]:
+        return [p for m, p, _ in self.calls if method in (None, m)]
+
+    def handle(self, method: str, path: str, body: Any) -> Response:
+        path = path.split("?")[0]
+        with self._lock:
+            self.calls.append((method, path, body))
+            failure = next(
+                (
+                    f
+                    for f in self._failures
+                    if f["method"] == method and f["path"].search(path)
+                ),
+                None,
+            )
+            if failure:
+                self._failures.remove(failure)
+            if failure and not failure["applied"]:
+                return _error(failure)
+            response = self._route(method, path, body)
+            return _error(failure) if failure else response
+
+    def _route(self, method: str, path: str, body: Any) -> Response:
+        if path == "/token":
+            return 200, {}, {"access_token": "fake", "expires_in": 3600}
+        if method == "GET" and path == "/files/generateIds":
+            return 200, {}, {"ids": [f"file{next(self._ids)}" for _ in range(100)]}
+        if method == "POST" and path == "/files":
+            if body["id"] in self.files:
+                return _error(dict(status=409, reason="duplicate"))
+            self.files[body["id"]] = dict(body, permissions=[])
+            return 200, {}, {"id": body["id"]}
+        match = re.fullmatch(
+            r"/files/([^/]+)/permissions"
+            r"|/v1/documents/([^/:]+):batchUpdate"
+            r"|/v4/spreadsheets/([^/]+)/values/A1",
+            path,
+        )
+        file = (
+            self.files.get(next(filter(None, match.groups()), None)) if match else None
+        )
+        if file is None:
+            return _error(dict(status=404, reason="notFound"))
+        if path.endswith("/permissions"):
+            file["permissions"].append(body)
+            return 200, {}, {"id": f"permission{len(file['permissions'])}"}
+        if path.endswith(":batchUpdate"):
+            file["text"] = body["requests"][0]["insertText"]["text"]
+            return 200, {}, {"documentId": file["id"], "replies": [{}]}
+        file["values"] = body["values"]
+        return (
+            200,
+            {},
+            {"updatedRange": "Sheet1!A1", "updatedRows": len(body["values"])},
+        )
+
+    def handle_batch(self, content_type: str, body: bytes) -> Tuple[str, bytes]:
+        boundary = content_type.split("boundary=")[1].strip('"')
+        parts = []
+        for part in body.decode().split(f"--{boundary}"):
+            if "Content-ID:" not in part:
+                continue
+            content_id = re.search(r"Content-ID: <(.+)>", part).group(1)
+            request = part.replace("\r\n", "\n").split("\n\n", 1)[1]
+            head, _, payload = request.partition("\n\n")
+            method, path, _ = head.split("\n")[0].split(" ")
+            parts.append((content_id, method, path, payload.strip()))
+        with self._lock:
+            self.batches.append([path.split("?")[0] for _, _, path, _ in parts])
+        out = []
+        for content_id, method, path, payload in parts:
+            status, headers, reply = self.handle(
+                method, path, json.loads(payload) if payload else None
+            )
+            lines = [f"HTTP/1.1 {status} {REASONS[status]}"]
+            lines += [f"{k}: {v}" for k, v in headers.items()]
+            lines += ["Content-Type: application/json", "", json.dumps(reply)]
+            out.append(
+                f"--batch_response\r\nContent-Type: application/http\r\n"
+                f"Content-ID: <response-{content_id}>\r\n\r\n" + "\r\n".join(lines)
+            )
+        out.append("--batch_response--")
+        return "multipart/mixed; boundary=batch_response", "\r\n".join(out).encode()
+
+
+def private_key() -> str:
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    return key.private_bytes(
+        serialization.Encoding.PEM,
+        serialization.PrivateFormat.PKCS8,
+        serialization.NoEncryption(),
+    ).decode()
+
+
+def _error(failure: dict) -> Response:
+    status = failure["status"]
+    headers = failure.get("headers", {})
+    errors = [{"reason": failure["reason"]}] if failure.get("reason") else []
+    return status, headers, {"error": {"code": status, "errors": errors}}
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def _reply(self, status: int, headers: Dict[str, str], content_type: str, data):
+        self.send_response(status)
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _handle(self):
+        fake: FakeGoogle = self.server.fake
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if self.path.startswith("/batch/"):
+            content_type, data = fake.handle_batch(self.headers["Content-Type"], body)
+            return self._reply(200, {}, content_type, data)
+        if self.path.startswith("/token"):
+            body = None
+        status, headers, reply = fake.handle(
+            self.command, self.path, json.loads(body) if body else None
+        )
+        self._reply(status, headers, "application/json", json.dumps(reply).encode())
+
+    do_GET = do_POST = do_PUT = _handle
@@ -0,0 +1,176 @@
+import json
+
+import pytest
+from fake_google import FakeGoogle, private_key
+from googleapiclient.http import HttpMockSequence
+
+from processieve.drive import GoogleDriveHandler, RequestScheduler
+
+
+@pytest.fixture(scope="module")
+def key():
+    # Generating a key is slow: one per module
+    return private_key()
+
+
+@pytest.fixture
+def fake():
+    fake = FakeGoogle()
+    fake.start()
+    yield fake
+    fake.stop()
+
+
+@pytest.fixture
+def handler(fake, key, tmp_path):
+    # Client pools are shared per service account file: a new file per test gives
+    # each its own pool and scheduler
+    service_account_file = tmp_path / "service_account.json"
+    service_account_file.write_text(json.dumps(fake.service_account_info(key)))
+    handler = GoogleDriveHandler(
+        str(service_account_file),
+        ["https://www.googleapis.com/auth/drive"],
+        endpoints=dict(drive=fake.url, docs=fake.url, sheets=fake.url),
+    )
+    handler.folder_id = "folder"
+    handler.drive_id = "drive"
+    # Retry without waiting, unless the server asks to
+    handler.pool.scheduler.max_backoff = 0.0
+    return handler
+
+
+def test_create_documents(fake, handler):
+    documents = [(f"Doc {i}", f"Text {i}") for i in range(3)]
+    urls = handler.create_documents(documents, share_email="someone@example.com")
+    assert len(urls) == 3
+    for url, (title, text) in zip(urls, documents):
+        doc_id = url.split("/")[-2]
+        assert url == f"https://docs.google.com/document/d/{doc_id}/edit"
+        file = fake.files[doc_id]
+        assert file["name"] == title
+        assert file["parents"] == ["folder"]
+        assert file["mimeType"] == "application/vnd.google-apps.document"
+        assert file["text"] == text
+        assert [p["emailAddress"] for p in file["permissions"]] == [
+            "someone@example.com"
+        ]
+    # The creates and the shares went in one batch each
+    assert fake.batches == [
+        ["/files"] * 3,
+        [f"/files/{url.split('/')[-2]}/permissions" for url in urls],
+    ]
+    assert fake.paths("POST").count("/files") == 3
+
+
+def test_create_spreadsheets(fake, handler):
+    sheets = [("Sheet", [["a", 1], ["b", 2]]), ("Empty", [])]
+    urls = handler.create_spreadsheets(sheets)
+    ids = [url.split("/")[-2] for url in urls]
+    assert urls == [f"https://docs.google.com/spreadsheets/d/{i}/edit" for i in ids]
+    assert [fake.files[i]["name"] for i in ids] == ["Sheet", "Empty"]
+    assert fake.files[ids[0]]["values"] == [["a", 1], ["b", 2]]
+    # Nothing to write in an empty sheet, nor anyone to share with
+    assert "values" not in fake.files[ids[1]]
+    assert fake.paths("PUT") == [f"/v4/spreadsheets/{ids[0]}/values/A1"]
+    assert fake.batches == [["/files"] * 2]
+
+
+def test_create_documents_failures(fake, handler):
+    fake.fail("POST", r"^/files$", 403, reason="insufficientFilePermissions")
+    fake.fail("POST", r":batchUpdate$", 404)
+    urls = handler.create_documents([("A", "a"), ("B", "b"), ("C", "c")])
+    # One create was refused, and one doc could not be filled, the other is fine
+    assert urls.count(None) == 2
+    (url,) = filter(None, urls)
+    assert fake.files[url.split("/")[-2]]["text"] in ("b", "c")
+    assert len(fake.batches) == 1
+
+
+@pytest.mark.parametrize(
+    "status,reason", [("429", None), ("403", "userRateLimitExceeded")]
+)
+def test_send_waits_as_asked_when_throttled(status, reason):
+    scheduler = RequestScheduler()
+    errors = [{"reason": reason}] if reason else []
+    http = HttpMockSequence(
+        [
+            (
+                {"status": status, "retry-after": "0.05"},
+                json.dumps({"error": {"errors": errors}}),
+            ),
+            ({"status": "200"}, '{"id": "file"}'),
+        ]
+    )
+    response, content = scheduler.send(
+        http, "https://www.googleapis.com/drive/v3/files/file", "GET"
+    )
+    assert response.status == 200
+    assert content == b'{"id": "file"}'
+    assert len(http.request_sequence) == 2
+    stats = scheduler.stats()
+    assert (stats["calls"], stats["retries"], stats["throttled"]) == (2, 1, 1)
+    assert stats["backed_off"] == 0.05
+
+
+def test_send_retries_idempotent_server_errors():
+    scheduler = RequestScheduler(max_retries=2, max_backoff=0.0)
+    http = HttpMockSequence([({"status": "503"}, "{}")] * 3)
+    response, _ = scheduler.send(
+        http, "https://www.googleapis.com/drive/v3/files/file", "GET"
+    )
+    # Given up after the last retry
+    assert response.status == 503
+    assert len(http.request_sequence) == 3
+    assert scheduler.stats()["failed"] == 1
+
+
+def test_send_does_not_retry_docs_batch_update():
+    scheduler = RequestScheduler(max_backoff=0.0)
+    http = HttpMockSequence([({"status": "500"}, "{}"), ({"status": "200"}, "{}")])
+    response, _ = scheduler.send(
+        http,
+        "https://docs.googleapis.com/v1/documents/doc:batchUpdate",
+        "POST",
+        body='{"requests": []}',
+    )
+    # It may have been applied: inserting the text twice would duplicate it
+    assert response.status == 500
+    assert len(http.request_sequence) == 1
+    assert scheduler.stats()["retries"] == 0
+
+
+def test_failed_text_insertion_is_not_retried(fake, handler):
+    fake.fail("POST", r":batchUpdate$", 500, applied=True)
+    (url,) = handler.create_documents([("Doc", "Text")])
+    assert url is None
+    assert len([p for p in fake.paths() if p.endswith(":batchUpdate")]) == 1
+
+
+def test_batch_retries_only_throttled_calls(fake, handler):
+    fake.fail("POST", r"^/files$", 429, headers={"Retry-After": "0.01"})
+    urls = handler.create_documents([("A", "a"), ("B", "b"), ("C", "c")])
+    assert None not in urls
+    assert fake.batches == [["/files"] * 3, ["/files"]]
+    assert [fake.files[url.split("/")[-2]]["text"] for url in urls] == ["a", "b", "c"]
+    stats = handler.pool.scheduler.stats()
+    assert (stats["retries"], stats["throttled"]) == (1, 1)
+    assert stats["backed_off"] == 0.01
+
+
+def test_batch_create_conflict_on_retry(fake, handler):
+    # The first create goes through but its response is lost: the retry conflicts
+    fake.fail("POST", r"^/files$", 503, applied=True)
+    urls = handler.create_documents([("A", "a"), ("B", "b")])
+    assert None not in urls
+    assert fake.batches == [["/files"] * 2, ["/files"]]
+    assert len(fake.files) == 2
+    assert [fake.files[url.split("/")[-2]]["text"] for url in urls] == ["a", "b"]
+
+
+def test_create_conflict_on_retry(fake, handler):
+    fake.fail("POST", r"^/files$", 503, applied=True)
+    url = handler.create_document("Doc", "Text")
+    assert fake.paths("POST").count("/files") == 2
+    (file,) = fake.files.values()
+    assert url == f"https://docs.google.com/document/d/{file['id']}/edit"
+    assert file["text"] == "Text"
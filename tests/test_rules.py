@@ -0,0 +1,83 @@
+import math
+
+import pytest
+from orjson import dumps
+
+from processieve.rules import CompiledCondition
+
+CONDITION = dumps(
+    [
+        {
+            "ranges": {"age": [18, 65]},
+            "lists": {"region": ["north", "south"]},
+            "score": 0.9,
+        },
+        {"ranges": {"age": [0, 120], "income": [0, 1000]}, "score": 0.5},
+        {"lists": {"member": [True]}, "score": 0.2},
+        {"lists": {"tags": ["a", "b"]}, "score": 0.1},
+    ]
+).decode()
+
+SITUATIONS = [
+    # First clause wins over the second, which also matches
+    {"age": 30, "region": "north", "income": 10},
+    {"age": 30, "region": "west", "income": 10},
+    {"age": 30, "region": "west", "income": 5000},
+    # Bounds are inclusive
+    {"age": 18, "region": "south"},
+    {"age": 65.0, "region": "south"},
+    # Missing, NaN and non numeric values never satisfy a range
+    {"region": "north"},
+    {"age": math.nan, "region": "north", "income": 1},
+    {"age": "30", "region": "north", "income": 1},
+    {"age": None, "income": None},
+    # Bools are numbers, and members of lists of bools
+    {"age": True, "income": False},
+    {"member": True},
+    {"member": 1},
+    {"member": "true"},
+    # Unhashable answers are never members
+    {"tags": ["a"]},
+    {"tags": {"a": 1}},
+    {"tags": "a", "member": [True]},
+    {},
+]
+
+
+def test_match_many_agrees_with_match():
+    condition = CompiledCondition.parse(CONDITION)
+    expected = [condition.match(situation) for situation in SITUATIONS]
+    scores = condition.match_many(SITUATIONS)
+    assert [None if math.isnan(s) else s for s in scores] == expected
+
+
+def test_match_first_clause():
+    condition = CompiledCondition.parse(CONDITION)
+    assert condition.match(SITUATIONS[0]) == 0.9
+    assert condition.match(SITUATIONS[1]) == 0.5
+    assert condition.match(SITUATIONS[2]) is None
+    assert condition.match({"tags": ["a"]}) is None
+    assert condition.match({"tags": "b"}) == 0.1
+
+
+def test_match_many_empty():
+    condition = CompiledCondition.parse(CONDITION)
+    assert condition.match_many([]).shape == (0,)
+
+
+@pytest.mark.parametrize(
+    "condition, message",
+    [
+        ("not json", "not valid JSON"),
+        ('{"score": 1}', "list of clauses"),
+        ("[1]", "Invalid clause 0"),
+        ('[{"score": 1}, {"lists": {}}]', "Invalid clause 1"),
+        ('[{"ranges": {"age": [1]}, "score": 1}]', "Invalid clause 0"),
+        ('[{"ranges": {"age": ["a", "b"]}, "score": 1}]', "Invalid clause 0"),
+        ('[{"lists": {"tags": [[1]]}, "score": 1}]', "Invalid clause 0"),
+        ('[{"score": "high"}]', "Invalid clause 0"),
+    ],
+)
+def test_parse_errors(condition, message):
+    with pytest.raises(ValueError, match=message):
+        CompiledCondition.parse(condition)